@@ -1,5 +1,6 @@
 # launch_app.py – bruges til at bygge .exe og starte Streamlit
 
+import multiprocessing
 import os
 import sys
 import traceback
@@ -85,4 +86,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # needed for the billing-parse process pool in the frozen exe
+    multiprocessing.freeze_support()
     main()
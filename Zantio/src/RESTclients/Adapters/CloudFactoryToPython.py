@@ -1,146 +1,216 @@
+from dataclasses import dataclass, fields
 from datetime import datetime
+from functools import lru_cache
 from math import copysign
+from typing import Any, Callable, Optional
 
 from RESTclients.dataModels import CustomerInvoiceCategoryLineBase
 
 
+# ------------------------------------------------------------------
+# Field sources used to declare a category's line layout
+# ------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class Column:
+    """Value of a billing column (record.get(name, default)), optionally converted."""
+    name: str
+    default: Any = "Failed"
+    convert: Optional[Callable[[Any], Any]] = None
+
+
+@dataclass(frozen=True)
+class Const:
+    value: Any
+
+
+@dataclass(frozen=True)
+class RowDate:
+    """A dd-mm-yy date column of the billing row."""
+    name: str
+
+
+class InvoiceStart:
+    pass
+
+
+class InvoiceEnd:
+    pass
+
+
+@dataclass(frozen=True)
+class CategoryLineSpec:
+    """
+    How one CloudFactory billing category maps onto CustomerInvoiceCategoryLineBase.
+    fixed_unit_price overrides the billing price: Amount = Quantity * fixed_unit_price.
+    """
+    Amount: Any = Column("Retail Amount")
+    Currency: Any = Column("Currency")
+    ItemName: Any = Column("Item Name")
+    ItemNo: Any = Column("Item No")
+    Units: Any = Const("stk")
+    CustomerName: Any = Column("Portal Customer Name", None)
+    ProductFamily: Any = Column("Description")
+    Quantity: Any = Column("Quantity", 0.0, float)
+    UnitPrice: Any = Column("Unit Price")
+    PeriodStart: Any = RowDate("Start Date")
+    PeriodEnd: Any = RowDate("End Date")
+    fixed_unit_price: Optional[float] = None
+
+
+CATEGORY_LINE_SPECS = {
+    "Exclaimer": CategoryLineSpec(
+        ItemName=Column("Item Name", "Exclaimer Failed"),
+        ProductFamily=Column("Subscription Name"),
+    ),
+    "SPLA": CategoryLineSpec(
+        Amount=Column("Amount"),
+        ItemName=Column("Item Name", "SPLA Failed"),
+        ProductFamily=Column("Product Family"),
+        PeriodStart=InvoiceStart(),
+        PeriodEnd=InvoiceEnd(),
+    ),
+    "Microsoft CSP (NCE)": CategoryLineSpec(
+        ItemName=Column("Nickname", "CSP Failed"),
+        ProductFamily=Column("Description"),
+    ),
+    "Keepit": CategoryLineSpec(
+        ItemName=Column("Item Name", "Keepit Failed"),
+        ProductFamily=Column("Connector"),
+    ),
+    "Acronis": CategoryLineSpec(
+        ItemName=Column("Description", "Acronis Failed"),
+        Units=Column("Unit"),
+        ProductFamily=Column("Description"),
+    ),
+    "Dropbox": CategoryLineSpec(
+        ItemName=Column("Description", "Dropbox Failed"),
+        ProductFamily=Const("Dropbox"),
+        Quantity=Column("License Quantity", 0.0, float),
+        PeriodStart=InvoiceStart(),
+        PeriodEnd=InvoiceEnd(),
+    ),
+    "Impossible Cloud": CategoryLineSpec(
+        ItemName=Const("cloud service"),
+        ProductFamily=Const("cloud service"),
+        PeriodStart=InvoiceStart(),
+        PeriodEnd=InvoiceEnd(),
+        fixed_unit_price=50,
+    ),
+    "Microsoft NCE (Azure)": CategoryLineSpec(
+        Amount=Column("Retail Amount", 0.0),
+        ItemName=Column("Description", "Azure Failed"),
+        ItemNo=Column("Product Id"),
+        ProductFamily=Column("Product Group", None),
+        PeriodStart=InvoiceStart(),
+        PeriodEnd=InvoiceEnd(),
+    ),
+}
+
+# any category not listed above
+DEFAULT_LINE_SPEC = CategoryLineSpec(
+    Amount=Column("Amount", 0.0, float),
+    ItemName=Column("Description", "else Failed"),
+    ProductFamily=Const("Dropbox"),
+    UnitPrice=Column("Unit Price", 0.0, float),
+    PeriodStart=RowDate("Billing Start Date"),
+    PeriodEnd=InvoiceEnd(),
+)
+
+LINE_FIELDS = [f.name for f in fields(CustomerInvoiceCategoryLineBase)]
+
+# distinct date strings seen in one run; a billing period only has a handful
+BILLING_DATE_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=BILLING_DATE_CACHE_SIZE)
+def parse_billing_date(value, fmt="%d-%m-%y"):
+    """
+    Parse a billing-Excel date string. Memoised, since thousands of rows repeat
+    the same few period dates. Failures are not cached and raise as before.
+    """
+    return datetime.strptime(value, fmt).date()
+
+
+def billing_date_cache_info():
+    """hits / misses / currsize of the date memo, for profiling."""
+    return parse_billing_date.cache_info()
+
+
+def _compile_source(source, positions):
+    """Turn a field source into getter(row, startDate, endDate) bound to a column position."""
+    if isinstance(source, Const):
+        value = source.value
+        return lambda row, startDate, endDate: value
+    if isinstance(source, InvoiceStart):
+        return lambda row, startDate, endDate: startDate
+    if isinstance(source, InvoiceEnd):
+        return lambda row, startDate, endDate: endDate
+    if isinstance(source, RowDate):
+        source = Column(source.name, "Failed", parse_billing_date)
+
+    convert = source.convert
+    position = positions.get(source.name)
+    if position is None:
+        # column is not in this file - every row gets the default
+        default = source.default
+        if convert is None:
+            return lambda row, startDate, endDate: default
+        return lambda row, startDate, endDate: convert(default)
+    if convert is None:
+        return lambda row, startDate, endDate: row.at(position)
+    return lambda row, startDate, endDate: convert(row.at(position))
+
+
+def compile_line_mapper(catName, headers):
+    """
+    Build the row -> CustomerInvoiceCategoryLineBase function for one category and
+    one header layout. Column names are resolved to positions here, once per file,
+    so mapping a row is just a handful of indexed reads.
+    The returned mapper takes (row, startDate, endDate) and reads only the columns
+    it needs, by position, through row.at(position) (SheetRow, BillingRow).
+    """
+    spec = CATEGORY_LINE_SPECS.get(catName, DEFAULT_LINE_SPEC)
+    positions = {h: i for i, h in enumerate(headers)}
+
+    sources = {name: getattr(spec, name) for name in LINE_FIELDS}
+    if spec.fixed_unit_price is not None:
+        price = spec.fixed_unit_price
+        sources["Amount"] = Column(sources["Quantity"].name, 0.0, lambda q: float(q) * price)
+        sources["UnitPrice"] = Const(price)
+
+    getters = [_compile_source(sources[name], positions) for name in LINE_FIELDS]
+
+    def mapper(row, startDate, endDate):
+        line = CustomerInvoiceCategoryLineBase(*[get(row, startDate, endDate) for get in getters])
+        return _finish_line(catName, line)
+
+    return mapper
+
+
+@lru_cache(maxsize=64)
+def _mapper_for_keys(catName, keys):
+    return compile_line_mapper(catName, keys)
+
+
+class _DictRow:
+    __slots__ = ("values",)
+
+    def __init__(self, record):
+        self.values = list(record.values())
+
+    def at(self, position):
+        return self.values[position]
+
+
 def generate_correct_product_line(catName, record, startDate, endDate):
-    if catName == "Exclaimer":
-        start = datetime.strptime(record.get("Start Date", "Failed"), "%d-%m-%y").date()
-        end = datetime.strptime(record.get("End Date", "Failed"), "%d-%m-%y").date()
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Retail Amount", "Failed"),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Item Name", "Exclaimer Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName = record.get("Portal Customer Name"),
-            ProductFamily=record.get("Subscription Name", "Failed"),
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=start,
-            PeriodEnd=end,
-        )
-    elif catName == "SPLA":
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Amount", "Failed"),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Item Name", "SPLA Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily=record.get("Product Family", "Failed"),
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=startDate,
-            PeriodEnd=endDate
-        )
-    elif catName == "Microsoft CSP (NCE)":
-        start = datetime.strptime(record.get("Start Date", "Failed"), "%d-%m-%y").date()
-        end = datetime.strptime(record.get("End Date", "Failed"), "%d-%m-%y").date()
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Retail Amount", "Failed"),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Nickname", "CSP Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily=record.get("Description", "Failed"),
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=start,
-            PeriodEnd=end
-        )
-    elif catName == "Keepit":
-        start = datetime.strptime(record.get("Start Date", "Failed"), "%d-%m-%y").date()
-        end = datetime.strptime(record.get("End Date", "Failed"), "%d-%m-%y").date()
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Retail Amount", "Failed"),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Item Name", "Keepit Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily=record.get("Connector", "Failed"),
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=start,
-            PeriodEnd=end
-        )
-    elif catName == "Acronis":
-        start = datetime.strptime(record.get("Start Date", "Failed"), "%d-%m-%y").date()
-        end = datetime.strptime(record.get("End Date", "Failed"), "%d-%m-%y").date()
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Retail Amount", "Failed"),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Description", "Acronis Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units=record.get("Unit", "Failed"),
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily=record.get("Description", "Failed"),
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=start,
-            PeriodEnd=end
-        )
-    elif catName == "Dropbox":
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Retail Amount", "Failed"),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Description", "Dropbox Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily="Dropbox",
-            Quantity=float(record.get("License Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=startDate,
-            PeriodEnd=endDate
-        )
-    elif catName == "Impossible Cloud":
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=float(record.get("Quantity", 0.0))*50,
-            Currency=record.get("Currency", "Failed"),
-            ItemName="cloud service",
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily="cloud service",
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=50,
-            PeriodStart=startDate,
-            PeriodEnd=endDate
-        )
-    elif catName == "Microsoft NCE (Azure)":
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=record.get("Retail Amount", 0.0),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Description", "Azure Failed"),
-            ItemNo=record.get("Product Id", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily=record.get("Product Group"),
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=record.get("Unit Price", "Failed"),
-            PeriodStart=startDate,
-            PeriodEnd=endDate
-        )
-    else:
-        start = datetime.strptime(record.get("Billing Start Date", "Failed"), "%d-%m-%y").date()
-        line = CustomerInvoiceCategoryLineBase(
-            Amount=float(record.get("Amount", 0.0)),
-            Currency=record.get("Currency", "Failed"),
-            ItemName=record.get("Description", "else Failed"),
-            ItemNo=record.get("Item No", "Failed"),
-            Units="stk",
-            CustomerName=record.get("Portal Customer Name"),
-            ProductFamily="Dropbox",
-            Quantity=float(record.get("Quantity", 0.0)),
-            UnitPrice=float(record.get("Unit Price", 0.0)),
-            PeriodStart=start,
-            PeriodEnd=endDate,
-        )
+    """Map a single billing record (dict or sheet row) to a line. Prefer compile_line_mapper in loops."""
+    if hasattr(record, "headers"):
+        return _mapper_for_keys(catName, tuple(record.headers))(record, startDate, endDate)
+    return _mapper_for_keys(catName, tuple(record.keys()))(_DictRow(record), startDate, endDate)
+
 
+def _finish_line(catName, line):
     if abs(round(line.Quantity, 5)) < 0.00001:
         line.Quantity = copysign(1, line.Quantity)
 
@@ -152,7 +222,4 @@ def generate_correct_product_line(catName, record, startDate, endDate):
         print(catName)
     #line.Amount = round(line.Amount, 2)
 
-
-
     return line
-
@@ -0,0 +1,202 @@
+"""
+Disk cache for CloudFactory billing workbooks.
+
+Workbooks are stored content-addressed (<sha256>.xlsx) under the output folder,
+and index.json maps (invoice period, category, url hash) to a blob together with
+its size and last use. When the cache grows past its size budget the least
+recently used entries are evicted.
+
+Several sessions and processes share the folder: every change takes a file
+lock (index.lock), reloads index.json, applies only its own change and writes
+it back. Blobs no entry refers to (fx from a crashed writer) are deleted.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+from reconcilliation.utils import CACHE_DIR
+
+BILLING_CACHE_DIR = CACHE_DIR / "billing"
+BILLING_CACHE_MAX_MB = int(os.getenv("CLOUDFACTORY_CACHE_MAX_MB", "512"))
+# temp files older than this are left over from a crashed writer
+STALE_TMP_SECONDS = 3600
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Exclusive lock on path, across threads and processes."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK retries for ~10 seconds, then raises
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class BillingExcelCache:
+
+    def __init__(self, cache_dir: Path = BILLING_CACHE_DIR, max_bytes: int = BILLING_CACHE_MAX_MB * 1024 * 1024, refresh: bool = False) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+        # counters and the in-memory copy; the index file itself is guarded by _file_lock
+        self._lock = threading.Lock()
+        self._index_path = self.cache_dir / "index.json"
+        self._lock_path = self.cache_dir / "index.lock"
+        self._entries = self._read_index()
+
+    @staticmethod
+    def make_key(period: str, category: str, excel_url: str) -> str:
+        """
+        The query string is left out of the url hash: CloudFactory hands out
+        signed download links, so the same file gets a new query on every call.
+        """
+        parts = urlsplit(excel_url)
+        url_hash = hashlib.sha256(f"{parts.netloc}{parts.path}".encode("utf-8")).hexdigest()[:16]
+        return f"{period}|{category}|{url_hash}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = None
+        if not self.refresh:
+            with self._locked_index() as entries:
+                entry = entries.get(key)
+
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            data = self._blob_path(entry["sha256"]).read_bytes()
+        except OSError:
+            data = None
+        valid = data is not None and hashlib.sha256(data).hexdigest() == entry["sha256"]
+
+        with self._locked_index(write=True) as entries:
+            current = entries.get(key)
+            if current is not None and current["sha256"] == entry["sha256"]:
+                if valid:
+                    current["last_used"] = time.time()
+                else:
+                    # missing or damaged blob - forget it and download again
+                    del entries[key]
+
+        with self._lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return data if valid else None
+
+    def put(self, key: str, data: bytes) -> None:
+        if not data:
+            return
+        sha = hashlib.sha256(data).hexdigest()
+        with self._locked_index(write=True) as entries:
+            # written under the lock, so a sweep in another process can't take it before it's indexed
+            blob = self._blob_path(sha)
+            if not blob.exists():
+                with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+                    f.write(data)
+                Path(f.name).replace(blob)
+
+            entries[key] = {"sha256": sha, "size": len(data), "last_used": time.time()}
+            self._evict(entries)
+            self._sweep(entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes(self._entries),
+            }
+
+    def _blob_path(self, sha: str) -> Path:
+        return self.cache_dir / f"{sha}.xlsx"
+
+    @contextmanager
+    def _locked_index(self, write: bool = False):
+        """The current index.json entries under the file lock; written back when write is set."""
+        with _file_lock(self._lock_path):
+            entries = self._read_index()
+            yield entries
+            if write:
+                self._write_index(entries)
+        with self._lock:
+            self._entries = entries
+
+    @staticmethod
+    def _total_bytes(entries: dict) -> int:
+        # identical workbooks share one blob, so count each sha once
+        return sum({e["sha256"]: e["size"] for e in entries.values()}.values())
+
+    def _evict(self, entries: dict) -> None:
+        by_age = sorted(entries.items(), key=lambda item: item[1]["last_used"])
+        while self._total_bytes(entries) > self.max_bytes and by_age:
+            key, entry = by_age.pop(0)
+            del entries[key]
+            if not any(e["sha256"] == entry["sha256"] for e in entries.values()):
+                self._blob_path(entry["sha256"]).unlink(missing_ok=True)
+
+    def _sweep(self, entries: dict) -> None:
+        """Delete blobs no entry refers to and temp files of crashed writers; called under the file lock."""
+        known = {e["sha256"] for e in entries.values()}
+        for blob in self.cache_dir.glob("*.xlsx"):
+            if blob.stem not in known:
+                blob.unlink(missing_ok=True)
+        cutoff = time.time() - STALE_TMP_SECONDS
+        for tmp in self.cache_dir.glob("*.tmp"):
+            try:
+                if tmp.stat().st_mtime < cutoff:
+                    tmp.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+    def _read_index(self) -> dict:
+        if not self._index_path.exists():
+            return {}
+        try:
+            with self._index_path.open("r", encoding="utf-8") as f:
+                return json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            print(f"Billing cache index {self._index_path} is unreadable - starting with an empty cache")
+            return {}
+
+    def _write_index(self, entries: dict) -> None:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self._index_path.parent, suffix=".tmp", delete=False) as f:
+            json.dump({"entries": entries}, f, indent=2)
+        Path(f.name).replace(self._index_path)
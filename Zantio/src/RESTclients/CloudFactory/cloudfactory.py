@@ -1,25 +1,39 @@
 import requests
 import os
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
+from requests.adapters import HTTPAdapter
+
+from RESTclients.CloudFactory.billing_cache import BillingExcelCache
 from RESTclients.dataModels import Customer, CloudFactoryInvoiceCategory, CloudFactoryInvoice
+from reconcilliation.utils import in_run_context
 
 CLOUDFACTORY_EXCHANGE = os.getenv("CLOUDFACTORY_EXCHANGE")
 CLOUDFACTORY_PARTNER_ID = os.getenv("CLOUDFACTORY_PARTNER_ID")
 CLOUDFACTORY_API_TOKEN = ""
 CLOUDFACTORY_BASE_URL = "https://portal.api.cloudfactory.dk/"
+CLOUDFACTORY_DOWNLOAD_WORKERS = int(os.getenv("CLOUDFACTORY_DOWNLOAD_WORKERS", "6"))
+CLOUDFACTORY_PAGE_WORKERS = int(os.getenv("CLOUDFACTORY_PAGE_WORKERS", "4"))
 
 if not CLOUDFACTORY_EXCHANGE or not CLOUDFACTORY_PARTNER_ID:
     raise RuntimeError("Missing exchange API credentials. Set CLOUDFATORY_EXCHANGE and CLOUDFATORY_PARTNER_ID.")
 
 class CloudFactoryClient:
 
-    def __init__(self, base_url: str = "", partner_id: str = "") -> None:
+    def __init__(self, base_url: str = "", partner_id: str = "", download_workers: int = 0, refresh_cache: bool = False) -> None:
         self.base_url = base_url.rstrip("/") or CLOUDFACTORY_BASE_URL.rstrip("/")
         self.partner_id = partner_id or CLOUDFACTORY_PARTNER_ID
+        self.download_workers = max(1, download_workers or CLOUDFACTORY_DOWNLOAD_WORKERS)
         self.session = requests.Session()
+        # one pooled connection per download worker, so parallel downloads don't queue on the pool
+        adapter = HTTPAdapter(pool_connections=self.download_workers, pool_maxsize=self.download_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.excel_cache = BillingExcelCache(refresh=refresh_cache)
         self.accessToken = ""
         self._exchange_token_for_api_token(CLOUDFACTORY_EXCHANGE)
         self.session.headers.update({
@@ -27,12 +41,12 @@ class CloudFactoryClient:
             "Accept": "application/json",
         })
 
-    def _get(self, path: str, params: Dict[str, Any] = None, type = "json") -> Any:
+    def _get(self, path: str, params: Dict[str, Any] = None, type = "json", timeout=None) -> Any:
         if path.startswith("https"):
             url = path
         else:
             url = f"{self.base_url}{path}"
-        resp = self.session.get(url, params=params or {})
+        resp = self.session.get(url, params=params or {}, timeout=timeout)
         if not resp.ok:
             raise RuntimeError(f"CloudFactory GET {url} failed: {resp.status_code} {resp.text}")
 
@@ -117,11 +131,41 @@ class CloudFactoryClient:
 
         return ret_list, True
 
-    def list_customers(self) -> List[Customer]:
+    def list_customers(self, parallel: bool = True, max_workers: int = 0) -> List[Customer]:
         """
         Fetch all customers under this partner.
-        Adjust endpoint and response fields according to actual API.
+        With parallel=True page 1 is read first to learn totalPages, then the remaining
+        pages are fetched concurrently. Pages are always merged in page order.
         """
+        if not parallel:
+            return self._list_customers_serial()
+
+        pageSize = 250
+        data = self._get(
+            "/v2/customers/Customers",
+            params={"PageIndex": 1, "PageSize": pageSize}
+        )
+        totalPages = data.get("metadata").get("totalPages")
+        pageSize = data.get("metadata").get("pageSize")
+        customers = self._customers_from_page(data)
+
+        if totalPages and totalPages > 1:
+            workers = max(1, min(max_workers or CLOUDFACTORY_PAGE_WORKERS, totalPages - 1))
+
+            def fetch_page(page):
+                return self._get(
+                    "/v2/customers/Customers",
+                    params={"PageIndex": page, "PageSize": pageSize}
+                )
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # pool.map yields in submission order, so the merge is deterministic
+                for page_data in pool.map(in_run_context(fetch_page), range(2, totalPages + 1)):
+                    customers.extend(self._customers_from_page(page_data))
+
+        return customers
+
+    def _list_customers_serial(self) -> List[Customer]:
         customers: List[Customer] = []
         page = 0
         pageSize = 250
@@ -138,37 +182,82 @@ class CloudFactoryClient:
             )
             totalPages = data.get("metadata").get("totalPages")
             pageSize = data.get("metadata").get("pageSize")
-            items = data.get("results") or data  # depends on API style
-            if not items:
+            page_customers = self._customers_from_page(data)
+            if not page_customers:
                 break
 
-            for raw in items:
-                customer= Customer(
-                    id=str(raw["id"]),
-                    name=raw.get("name", "Unknown"),
-                    vatID=raw.get("vatId", None),
-                    countryCode=raw.get("countryCode", None),
-                    external_id=raw.get("externalCustomerId", None)  # adjust field name
-                )
-
-                customers.append(
-                    customer
-                )
+            customers.extend(page_customers)
 
         return customers
 
-    def fetch_billing_excel(self, excel_url, timeout=60):
-        """Download one billingDataExcel file and return it as a DataFrame."""
+    @staticmethod
+    def _customers_from_page(data) -> List[Customer]:
+        items = data.get("results") or []  # depends on API style
+        return [
+            Customer(
+                id=str(raw["id"]),
+                name=raw.get("name", "Unknown"),
+                vatID=raw.get("vatId", None),
+                countryCode=raw.get("countryCode", None),
+                external_id=raw.get("externalCustomerId", None)  # adjust field name
+            )
+            for raw in items
+        ]
+
+    def fetch_billing_excel(self, excel_url, timeout=60, period=None, category=None):
+        """
+        Download one billingDataExcel file and return the raw bytes.
+        When period and category are given the workbook is served from / stored in the disk cache.
+        """
         if not excel_url:
             raise Exception("excel URL is missing")
+
+        cache_key = None
+        if period and category:
+            cache_key = self.excel_cache.make_key(period, category, excel_url)
+            data = self.excel_cache.get(cache_key)
+            if data is not None:
+                return data
         try:
-            data = self._get(excel_url, type="excel")
+            data = self._get(excel_url, type="excel", timeout=timeout)
+            if cache_key:
+                self.excel_cache.put(cache_key, data)
             return data
         except Exception as e:
             short = excel_url[:120] + "..." if len(excel_url) > 120 else excel_url
             print(f"Failed to fetch billingDataExcel {short}: {e}")
             return None
 
+    def fetch_billing_excels(self, excel_links: List[tuple[str, str]], max_workers: int = 0, timeout=60) -> List[Optional[bytes]]:
+        """
+        Download several billingDataExcel files concurrently over the shared session.
+        excel_links is a list of (category, excelLink) or (category, excelLink, period) tuples;
+        the result keeps the same order. A failed download gives None for that entry,
+        same as fetch_billing_excel.
+        """
+        if not excel_links:
+            return []
+
+        workers = max(1, min(max_workers or self.download_workers, len(excel_links)))
+
+        def download(label, excel_url, period=None):
+            started = time.perf_counter()
+            data = self.fetch_billing_excel(excel_url, timeout=timeout, period=period, category=label)
+            elapsed = time.perf_counter() - started
+            size_kb = len(data) / 1024 if data else 0
+            status = "ok" if data is not None else "FAILED"
+            print(f"Downloaded {label:<30} {size_kb:>10,.0f} KB in {elapsed:6.2f}s ({status})")
+            return data
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(in_run_context(lambda link: download(*link)), excel_links))
+        print(f"Downloaded {len(excel_links)} billing files in {time.perf_counter() - started:.2f}s using {workers} workers")
+        cache_stats = self.excel_cache.stats()
+        print(f"Billing cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['bytes'] / 1024 / 1024:,.1f} MB on disk")
+
+        return results
+
     def fetch_partner_invoices_overview(self,partner_guid):
         url = f"/billing/accounts/{partner_guid}/invoices"
         data =  self._get(url)
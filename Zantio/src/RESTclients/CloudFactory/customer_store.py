@@ -0,0 +1,162 @@
+"""
+Local SQLite snapshot of CloudFactory customers.
+
+A run starts from the snapshot. Once the snapshot is older than its TTL it is
+synced against CloudFactory: only new or changed customers are written, and
+customers that no longer exist in CloudFactory are removed. The snapshot belongs
+to one CloudFactory partner id; it is rebuilt when the partner changes.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from RESTclients.dataModels import Customer
+from reconcilliation.utils import CACHE_DIR
+
+CUSTOMER_DB_PATH = CACHE_DIR / "customers.sqlite"
+CUSTOMER_SNAPSHOT_TTL_HOURS = float(os.getenv("CLOUDFACTORY_CUSTOMER_TTL_HOURS", "6"))
+
+SYNC_MODES = ("auto", "snapshot", "delta", "full")
+
+
+class CustomerSnapshotStore:
+
+    def __init__(self, db_path: Path = CUSTOMER_DB_PATH, ttl_hours: float = CUSTOMER_SNAPSHOT_TTL_HOURS) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_hours * 3600
+        self.last_sync_stats = {"added": 0, "changed": 0, "removed": 0}
+        self.last_sync_mode = None
+
+        self._conn = sqlite3.connect(self.db_path)
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS customers (
+                    id TEXT PRIMARY KEY,
+                    name TEXT,
+                    vat_id TEXT,
+                    country_code TEXT,
+                    external_id TEXT,
+                    row_hash TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def load(self) -> List[Customer]:
+        rows = self._conn.execute(
+            "SELECT id, name, vat_id, country_code, external_id FROM customers ORDER BY rowid"
+        ).fetchall()
+        return [
+            Customer(id=r[0], name=r[1], vatID=r[2], countryCode=r[3], external_id=r[4])
+            for r in rows
+        ]
+
+    def age_seconds(self) -> Optional[float]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'synced_at'").fetchone()
+        if not row:
+            return None
+        return time.time() - float(row[0])
+
+    def partner_id(self) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'partner_id'").fetchone()
+        return row[0] if row else None
+
+    def sync(self, client, mode: str = "auto") -> List[Customer]:
+        """
+        mode:
+          - "auto"     → use the snapshot while it is younger than the TTL, else "delta"
+          - "snapshot" → use the snapshot as is (only fetch if it is empty)
+          - "delta"    → fetch customers and write only new / changed / removed rows
+          - "full"     → drop the snapshot and rebuild it
+        """
+        if mode not in SYNC_MODES:
+            raise ValueError(f"mode skal være en af {SYNC_MODES}")
+
+        partner_id = str(getattr(client, "partner_id", "") or "")
+        age = self.age_seconds()
+        if age is not None and self.partner_id() != partner_id:
+            print("Customer snapshot belongs to another CloudFactory partner, rebuilding it")
+            mode = "full"
+
+        if mode == "auto":
+            mode = "snapshot" if age is not None and age < self.ttl_seconds else "delta"
+        if mode == "snapshot" and age is None:
+            mode = "delta"
+
+        self.last_sync_mode = mode
+        if mode == "snapshot":
+            self.last_sync_stats = {"added": 0, "changed": 0, "removed": 0}
+            print(f"Using customer snapshot ({age / 3600:.1f}h old)")
+            return self.load()
+
+        if mode == "full":
+            with self._conn:
+                self._conn.execute("DELETE FROM customers")
+
+        self.apply(client.list_customers(), partner_id)
+        stats = self.last_sync_stats
+        print(f"Customer snapshot synced: {stats['added']} new, {stats['changed']} changed, {stats['removed']} removed")
+        return self.load()
+
+    def apply(self, customers: List[Customer], partner_id: str = "") -> dict:
+        """Write a freshly fetched customer list into the snapshot, touching only rows that differ."""
+        known = dict(self._conn.execute("SELECT id, row_hash FROM customers").fetchall())
+
+        upserts = []
+        added = 0
+        for c in customers:
+            row_hash = self._row_hash(c)
+            previous = known.get(c.id)
+            if previous == row_hash:
+                continue
+            if previous is None:
+                added += 1
+            upserts.append((c.id, c.name, c.vatID, c.countryCode, c.external_id, row_hash))
+
+        removed = set(known) - {c.id for c in customers}
+
+        with self._conn:
+            self._conn.executemany(
+                """
+                INSERT INTO customers (id, name, vat_id, country_code, external_id, row_hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    name = excluded.name,
+                    vat_id = excluded.vat_id,
+                    country_code = excluded.country_code,
+                    external_id = excluded.external_id,
+                    row_hash = excluded.row_hash
+                """,
+                upserts,
+            )
+            self._conn.executemany("DELETE FROM customers WHERE id = ?", [(i,) for i in removed])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("synced_at", str(time.time())), ("partner_id", partner_id)],
+            )
+
+        self.last_sync_stats = {"added": added, "changed": len(upserts) - added, "removed": len(removed)}
+        return self.last_sync_stats
+
+    @staticmethod
+    def _row_hash(customer: Customer) -> str:
+        fields = (customer.id, customer.name, customer.vatID, customer.countryCode, customer.external_id)
+        return hashlib.sha1("\x1f".join("" if f is None else str(f) for f in fields).encode("utf-8")).hexdigest()
+
+
+def sync_customers(client, mode: str = "auto") -> List[Customer]:
+    """Open the snapshot, sync it (see CustomerSnapshotStore.sync) and close it again."""
+    store = CustomerSnapshotStore()
+    try:
+        return store.sync(client, mode=mode)
+    finally:
+        store.close()
@@ -0,0 +1,94 @@
+"""
+Disk snapshot of the Uniconta debtor index.
+
+Stores the (projected) debtor rows and the normalised ID/VAT index built from
+them, so a new process can skip both the DebtorClient download and the
+normalisation. The snapshot belongs to one Uniconta base url; it is ignored
+when the url changes.
+"""
+
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from reconcilliation.utils import CACHE_DIR
+
+DEBTOR_INDEX_PATH = CACHE_DIR / "uniconta_debtors.json"
+DEBTOR_INDEX_TTL_HOURS = float(os.getenv("UNICONTA_DEBTOR_TTL_HOURS", "12"))
+# delta loads can't see debtors deleted in Uniconta, so auto/delta do a full
+# reload once the last full one is older than this
+DEBTOR_INDEX_FULL_HOURS = float(os.getenv("UNICONTA_DEBTOR_FULL_HOURS", "168"))
+
+DEBTOR_SYNC_MODES = ("auto", "snapshot", "delta", "full")
+
+# bump when the index layout changes, older snapshots are then rebuilt
+DEBTOR_INDEX_FORMAT = 4
+
+
+class DebtorIndexSnapshot:
+
+    def __init__(self, path: Path = DEBTOR_INDEX_PATH, ttl_hours: float = DEBTOR_INDEX_TTL_HOURS,
+                 full_hours: float = DEBTOR_INDEX_FULL_HOURS) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_hours * 3600
+        self.full_seconds = full_hours * 3600
+
+    def load(self, base_url: str) -> Optional[dict]:
+        """
+        Returns {"synced_at", "full_synced_at", "server_modified", "rows", "by_vat"} with the by_vat entries
+        (rank, cc, row) pointing at the row dicts again, or None when there is no usable snapshot.
+        server_modified is the newest modified time Uniconta reported (None if unknown),
+        full_synced_at the time of the last full load (0 if unknown).
+        """
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("base_url") != base_url or data.get("format") != DEBTOR_INDEX_FORMAT:
+            return None
+
+        rows = data.get("rows") or []
+        by_vat = {
+            key: [(rank, cc, rows[i]) for rank, cc, i in entries]
+            for key, entries in (data.get("by_vat") or {}).items()
+        }
+        return {
+            "synced_at": float(data.get("synced_at", 0)),
+            "full_synced_at": float(data.get("full_synced_at") or 0),
+            "server_modified": data.get("server_modified"),
+            "rows": rows,
+            "by_vat": by_vat,
+        }
+
+    def save(self, base_url: str, rows: list, by_vat: dict, synced_at: float, server_modified: Optional[str] = None,
+             full_synced_at: Optional[float] = None) -> None:
+        positions = {id(row): i for i, row in enumerate(rows)}
+        data = {
+            "format": DEBTOR_INDEX_FORMAT,
+            "base_url": base_url,
+            "synced_at": synced_at,
+            "full_synced_at": synced_at if full_synced_at is None else full_synced_at,
+            "server_modified": server_modified,
+            "rows": rows,
+            "by_vat": {
+                key: [(rank, cc, positions[id(row)]) for rank, cc, row in matches]
+                for key, matches in by_vat.items()
+            },
+        }
+
+        # own temp file per writer, runs in other sessions may save at the same time
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.path.parent, suffix=".tmp", delete=False) as f:
+            json.dump(data, f, ensure_ascii=False, default=str)
+        Path(f.name).replace(self.path)
+
+    def is_fresh(self, synced_at: float) -> bool:
+        return time.time() - synced_at < self.ttl_seconds
+
+    def needs_full(self, full_synced_at: float) -> bool:
+        return time.time() - full_synced_at >= self.full_seconds
@@ -0,0 +1,105 @@
+"""
+Persistent link between CloudFactory customers and Uniconta debtors.
+
+Once a customer has been matched, its Uniconta Account is stored together with
+how it was found, when, and fingerprints of both sides (the customer's VAT data
+and the debtor row). Later runs use the stored Account directly and only match
+again when one of the fingerprints no longer fits. The fingerprints are plain
+joined field values, so checking one is a string compare.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from reconcilliation.utils import OUTPUT_DIR
+
+DEBTOR_MAPPING_PATH = OUTPUT_DIR / "customer_debtor_map.sqlite"
+
+
+class CustomerDebtorMap:
+
+    def __init__(self, base_url: str, db_path: Path = DEBTOR_MAPPING_PATH) -> None:
+        self.base_url = base_url or ""
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # used from the posting threads, every access goes through the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS customer_debtor (
+                    base_url TEXT NOT NULL,
+                    customer_id TEXT NOT NULL,
+                    account TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    matched_at REAL NOT NULL,
+                    customer_fp TEXT NOT NULL,
+                    debtor_fp TEXT NOT NULL,
+                    PRIMARY KEY (base_url, customer_id)
+                )
+                """
+            )
+
+        rows = self._conn.execute(
+            "SELECT customer_id, account, method, matched_at, customer_fp, debtor_fp FROM customer_debtor WHERE base_url = ?",
+            (self.base_url,),
+        ).fetchall()
+        self._entries = {
+            r[0]: {"account": r[1], "method": r[2], "matched_at": r[3], "customer_fp": r[4], "debtor_fp": r[5]}
+            for r in rows
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def customer_fingerprint(customer) -> str:
+        fields = (customer.vatID, customer.countryCode)
+        return "\x1f".join("" if f is None else str(f) for f in fields)
+
+    @staticmethod
+    def debtor_fingerprint(row: dict) -> str:
+        # rows are the projected debtor columns (see UnicontaClient._project_debtor_rows)
+        return "\x1f".join(f"{k}={row[k]}" for k in sorted(row))
+
+    def get(self, customer_id) -> Optional[dict]:
+        with self._lock:
+            return self._entries.get(str(customer_id))
+
+    def put(self, customer, account, method: str, customer_fp: str, debtor_fp: str) -> None:
+        """customer_fp/debtor_fp: computed once by the caller, see customer_fingerprint/debtor_fingerprint."""
+        entry = {
+            "account": str(account),
+            "method": method,
+            "matched_at": time.time(),
+            "customer_fp": customer_fp,
+            "debtor_fp": debtor_fp,
+        }
+        with self._lock:
+            self._entries[str(customer.id)] = entry
+            with self._conn:
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO customer_debtor
+                        (base_url, customer_id, account, method, matched_at, customer_fp, debtor_fp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (self.base_url, str(customer.id), entry["account"], method, entry["matched_at"],
+                     entry["customer_fp"], entry["debtor_fp"]),
+                )
+
+    def forget(self, customer_id) -> None:
+        with self._lock:
+            if self._entries.pop(str(customer_id), None) is None:
+                return
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM customer_debtor WHERE base_url = ? AND customer_id = ?",
+                    (self.base_url, str(customer_id)),
+                )
@@ -0,0 +1,237 @@
+"""
+Adaptive batching of DebtorOrderLineClientUser inserts.
+
+Lines from many orders are packed into Crud/InsertList calls of chunk_size
+lines. Orders are kept whole in a chunk when they fit; only orders larger than
+chunk_size are split. The chunk size grows by a fixed step after every accepted
+call and is halved when a chunk has to be sent again in smaller pieces.
+
+InsertList is not idempotent, so lines are only sent again when Uniconta can't
+have stored them: a 413 or a connection that was never opened. After a read
+timeout, a dropped connection or a 5xx the chunk may have been committed anyway;
+the orders in it are then read back (get_order_lines_by_order_number) and the
+chunk is only resent when none of its lines landed. Other 4xx answers are not
+retried, but when a rejected chunk held several orders, each order is sent on
+its own so one bad order does not fail its neighbours. Once a piece of an order
+has failed, its remaining pieces are not sent.
+
+Up to `workers` chunks are in flight at once, sent from a thread pool; the
+queue and the results are handled in the calling thread. Two chunks for the
+same Uniconta order (several invoices may share one) are never in flight
+together, so a read-back only sees lines that are already accounted for, and
+an order's lines keep their order.
+"""
+
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from reconcilliation.utils import in_run_context
+
+UNICONTA_LINE_CHUNK = int(os.getenv("UNICONTA_LINE_CHUNK", "200"))
+UNICONTA_LINE_CHUNK_MIN = int(os.getenv("UNICONTA_LINE_CHUNK_MIN", "10"))
+UNICONTA_LINE_CHUNK_MAX = int(os.getenv("UNICONTA_LINE_CHUNK_MAX", "1000"))
+UNICONTA_LINE_CHUNK_STEP = int(os.getenv("UNICONTA_LINE_CHUNK_STEP", "50"))
+UNICONTA_LINE_TIMEOUT = float(os.getenv("UNICONTA_LINE_TIMEOUT", "60"))
+
+_OK, _SHRINK, _REJECTED, _UNCERTAIN, _FAILED = "ok", "shrink", "rejected", "uncertain", "failed"
+
+
+def line_signature(line) -> tuple:
+    """What identifies a posted line when reading an order back from Uniconta."""
+    try:
+        qty = float(line.get("Qty") or 0)
+    except (TypeError, ValueError):
+        qty = line.get("Qty")
+    return str(line.get("Item")), str(line.get("Text")), str(line.get("Note")), qty
+
+
+class AdaptiveLineBatcher:
+
+    def __init__(self, client, chunk_size: int = 0, min_size: int = 0, max_size: int = 0, step: int = 0, timeout: float = 0, workers: int = 1) -> None:
+        self.client = client
+        self.workers = max(1, workers)
+        self.min_size = max(1, min_size or UNICONTA_LINE_CHUNK_MIN)
+        self.max_size = max(self.min_size, max_size or UNICONTA_LINE_CHUNK_MAX)
+        self.chunk_size = min(max(chunk_size or UNICONTA_LINE_CHUNK, self.min_size), self.max_size)
+        self.step = step or UNICONTA_LINE_CHUNK_STEP
+        self.timeout = timeout or UNICONTA_LINE_TIMEOUT
+
+        self.requests = 0
+        self.retries = 0
+        self.verifications = 0
+        # order number -> Counter of line signatures accepted in this batcher
+        self._accepted = {}
+        # counters and _accepted are touched from the sending threads
+        self._lock = threading.Lock()
+
+    def post(self, orders, on_done=None) -> list[bool]:
+        """
+        orders: list of (invoice, lines). Returns one bool per order, True when
+        every line of it was accepted. Orders without lines count as posted.
+        on_done(index) is called as soon as the last line of an order is accepted.
+        """
+        ok = [True] * len(orders)
+        remaining = [len(lines) for _, lines in orders]
+        if on_done is not None:
+            for i, count in enumerate(remaining):
+                if count == 0:
+                    on_done(i)
+        # queue items: (order index, lines, solo); solo pieces are never packed with other orders
+        queue = deque((i, lines, False) for i, (_, lines) in enumerate(orders) if lines)
+
+        start = time.perf_counter()
+        # the Uniconta order each invoice posts to; read-backs are per order
+        order_keys = [str(lines[0].get("OrderNumber")) if lines else None for _, lines in orders]
+        in_flight = {}  # future -> (pieces, lines)
+        busy = set()    # order keys with a chunk in flight
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while queue or in_flight:
+                while queue and len(in_flight) < self.workers:
+                    pieces = self._take(queue, busy, order_keys)
+                    if not pieces:
+                        break
+                    lines = [line for _, piece_lines, _ in pieces for line in piece_lines]
+                    busy.update(order_keys[i] for i, _, _ in pieces)
+                    in_flight[pool.submit(in_run_context(self._send_checked), lines)] = (pieces, lines)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pieces, lines = in_flight.pop(future)
+                    owners = {i for i, _, _ in pieces}
+                    busy.difference_update(order_keys[i] for i in owners)
+                    result = future.result()
+
+                    if result == _OK:
+                        self.chunk_size = min(self.max_size, self.chunk_size + self.step)
+                        for i, piece_lines, _ in pieces:
+                            remaining[i] -= len(piece_lines)
+                            if remaining[i] == 0 and ok[i] and on_done is not None:
+                                on_done(i)
+                    elif result == _SHRINK and len(lines) > self.min_size:
+                        self.chunk_size = max(self.min_size, len(lines) // 2)
+                        self.retries += 1
+                        queue.extendleft(reversed(pieces))
+                    elif result == _REJECTED and len(owners) > 1:
+                        self.retries += 1
+                        queue.extendleft(reversed([(i, piece_lines, True) for i, piece_lines, _ in pieces]))
+                    else:
+                        for i in owners:
+                            ok[i] = False
+                        # don't send the rest of an order that can no longer be posted whole
+                        queue = deque(item for item in queue if item[0] not in owners)
+
+        elapsed = time.perf_counter() - start
+        print(f"Posted {sum(len(lines) for _, lines in orders)} order lines in {self.requests} requests "
+              f"with {self.workers} workers ({self.retries} retries, {self.verifications} read-backs, "
+              f"{elapsed:.1f}s, chunk size now {self.chunk_size})")
+        return ok
+
+    def _take(self, queue, busy, order_keys) -> list:
+        """
+        Pop the next chunk of pieces off the queue, at most chunk_size lines.
+        Pieces whose Uniconta order is in busy stay queued in their place.
+        """
+        pieces = []
+        size = 0
+        skipped = []
+        while queue:
+            item = queue.popleft()
+            i, lines, solo = item
+            if order_keys[i] in busy:
+                skipped.append(item)
+                continue
+            if pieces and (solo or pieces[0][2]):
+                queue.appendleft(item)
+                break
+            room = self.chunk_size - size
+            if len(lines) <= room:
+                pieces.append(item)
+                size += len(lines)
+                continue
+            if pieces:
+                queue.appendleft(item)
+            else:
+                # order bigger than a whole chunk: send the head, keep the rest queued
+                queue.appendleft((i, lines[room:], solo))
+                pieces.append((i, lines[:room], solo))
+            break
+        queue.extendleft(reversed(skipped))
+        return pieces
+
+    def _send_checked(self, lines) -> str:
+        """Runs in a sending thread: _send, plus the read-back when the answer is uncertain."""
+        result = self._send(lines)
+        if result == _UNCERTAIN:
+            result = self._check_landed(lines)
+        if result == _OK:
+            self._remember(lines)
+        return result
+
+    def _send(self, lines) -> str:
+        with self._lock:
+            self.requests += 1
+        try:
+            response = self.client.post_order_lines(lines, timeout=self.timeout)
+        except requests.ConnectTimeout as e:
+            # the connection was never opened, nothing reached Uniconta
+            print(f"Order lines chunk of {len(lines)} failed: {e}")
+            return _SHRINK
+        except (requests.Timeout, requests.ConnectionError) as e:
+            print(f"Order lines chunk of {len(lines)} failed: {e}")
+            return _UNCERTAIN
+
+        if response.ok:
+            return _OK
+        print(f"Order lines chunk of {len(lines)} failed: {response.status_code} {response.text[:200]}")
+        if response.status_code == 413:
+            return _SHRINK
+        if response.status_code >= 500:
+            return _UNCERTAIN
+        return _REJECTED
+
+    def _remember(self, lines) -> None:
+        with self._lock:
+            for line in lines:
+                self._accepted.setdefault(str(line.get("OrderNumber")), Counter())[line_signature(line)] += 1
+
+    def _check_landed(self, lines) -> str:
+        """
+        Read the chunk's orders back after an answer that doesn't tell whether the
+        insert was committed. _OK when every line is there, _SHRINK (safe to resend)
+        when none is, _FAILED when only some are or the read-back fails.
+        Lines accepted earlier in this batcher are subtracted first.
+        """
+        with self._lock:
+            self.verifications += 1
+        expected = {}
+        for line in lines:
+            expected.setdefault(str(line.get("OrderNumber")), Counter())[line_signature(line)] += 1
+
+        landed = missing = 0
+        try:
+            for order_number, signatures in expected.items():
+                on_server = Counter(
+                    line_signature(row) for row in self.client.get_order_lines_by_order_number(order_number)
+                )
+                with self._lock:
+                    accepted = Counter(self._accepted.get(order_number, Counter()))
+                for signature, count in signatures.items():
+                    extra = max(0, on_server[signature] - accepted[signature])
+                    landed += min(extra, count)
+                    missing += count - min(extra, count)
+        except (requests.RequestException, RuntimeError) as e:
+            print(f"Could not read back orders after a failed chunk: {e}")
+            return _FAILED
+
+        if missing == 0:
+            print(f"Chunk of {len(lines)} order lines was stored after all")
+            return _OK
+        if landed == 0:
+            return _SHRINK
+        print(f"Chunk of {len(lines)} order lines was only partly stored ({landed} lines), not resending")
+        return _FAILED
@@ -0,0 +1,105 @@
+"""
+Local SQLite journal of what has been posted to Uniconta.
+
+Per CloudFactory customer and billing period (the CloudFactory invoice dates the
+run was given, never row data) it records the order number, a hash of the posted
+order lines and whether the insert finished. Entries are
+written as "pending" before the lines are sent and set to "done" once Uniconta
+accepted them, so a re-run after a crash can skip finished customers and check
+the half-finished ones instead of posting their lines twice.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+from reconcilliation.utils import OUTPUT_DIR
+
+POSTING_JOURNAL_PATH = OUTPUT_DIR / "posting_journal.sqlite"
+
+PENDING = "pending"
+DONE = "done"
+
+
+class PostingJournal:
+
+    def __init__(self, db_path: Path = POSTING_JOURNAL_PATH) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.db_path)
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS postings (
+                    customer_id TEXT NOT NULL,
+                    period_start TEXT NOT NULL,
+                    period_end TEXT NOT NULL,
+                    order_number TEXT,
+                    lines_hash TEXT NOT NULL,
+                    line_count INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (customer_id, period_start, period_end)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS postings_order ON postings (order_number)")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    @staticmethod
+    def key(invoice, billing_period: tuple) -> tuple:
+        """billing_period: (startDate, endDate) of the CloudFactory invoices, see ReconciliationContext."""
+        return str(invoice.customer.id), str(billing_period[0]), str(billing_period[1])
+
+    @staticmethod
+    def lines_hash(lines) -> str:
+        payload = json.dumps(lines, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: tuple) -> Optional[dict]:
+        row = self._conn.execute(
+            """
+            SELECT order_number, lines_hash, line_count, status, updated_at
+            FROM postings WHERE customer_id = ? AND period_start = ? AND period_end = ?
+            """,
+            key,
+        ).fetchone()
+        if not row:
+            return None
+        return {"order_number": row[0], "lines_hash": row[1], "line_count": row[2], "status": row[3], "updated_at": row[4]}
+
+    def begin(self, entries: Iterable[tuple]) -> None:
+        """entries: (key, order_number, lines_hash, line_count) about to be posted."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO postings
+                    (customer_id, period_start, period_end, order_number, lines_hash, line_count, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [(*key, None if order is None else str(order), h, n, PENDING, now) for key, order, h, n in entries],
+            )
+
+    def mark_done(self, keys: Iterable[tuple]) -> None:
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE postings SET status = ?, updated_at = ? WHERE customer_id = ? AND period_start = ? AND period_end = ?",
+                [(DONE, now, *key) for key in keys],
+            )
+
+    def forget_orders(self, order_numbers: Iterable) -> int:
+        """Drop entries for orders deleted in Uniconta, so they get posted again."""
+        with self._conn:
+            cur = self._conn.executemany(
+                "DELETE FROM postings WHERE order_number = ?",
+                [(str(o),) for o in order_numbers if o is not None],
+            )
+        return cur.rowcount
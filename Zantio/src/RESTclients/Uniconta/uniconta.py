@@ -1,19 +1,42 @@
 import os
+import threading
+import time
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.compat import basestring
 
-from RESTclients.dataModels import CustomerInvoice
+from RESTclients.dataModels import CustomerInvoice, CustomerIndex
+from RESTclients.Uniconta.debtor_cache import DebtorIndexSnapshot, DEBTOR_SYNC_MODES
+from RESTclients.Uniconta.debtor_mapping import CustomerDebtorMap
 from reconcilliation.utils import report_success_or_failure
 
+# orders per Crud/InsertList/DebtorOrderClient call in prepare_orders
+UNICONTA_ORDER_INSERT_CHUNK = int(os.getenv("UNICONTA_ORDER_INSERT_CHUNK", "200"))
+# order line chunks posted to Uniconta at once (AdaptiveLineBatcher), and the max open connections
+UNICONTA_POST_WORKERS = int(os.getenv("UNICONTA_POST_WORKERS", "4"))
+UNICONTA_MAX_CONNECTIONS = int(os.getenv("UNICONTA_MAX_CONNECTIONS", "8"))
+# rows per Query/Get page when reading large tables
+UNICONTA_QUERY_PAGE_SIZE = int(os.getenv("UNICONTA_QUERY_PAGE_SIZE", "1000"))
+
+# debtor fields kept in memory next to the ID/VAT fields (used for orders and reports)
+DEBTOR_FIELDS = {"Account", "Name", "Account Name", "Currency", "Country"}
+# how the debtor index snapshot is used, see _load_debtors_cache
+UNICONTA_DEBTOR_SYNC = os.getenv("UNICONTA_DEBTOR_SYNC", "auto").lower()
+# DebtorClient field holding the last change, used for delta loads
+UNICONTA_DEBTOR_MODIFIED_FIELD = os.getenv("UNICONTA_DEBTOR_MODIFIED_FIELD", "Updated")
+# format of the "since.." filter on that field, in UTC
+UNICONTA_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# stored with each customer -> debtor link; change it when the matching rules change,
+# links made by older rules are then matched again
+DEBTOR_MATCH_METHOD = "vat-key"
 
 
 class UnicontaClient:
 
-    customerDataBase: list
-
     def __init__(self) -> None:
 
         self.company_id = None
@@ -23,14 +46,52 @@ class UnicontaClient:
         self._userpass = os.getenv("ERP_PASSWORD")
 
         self.session = requests.Session()
+        # pool_block: extra threads wait for a free connection instead of opening more
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UNICONTA_MAX_CONNECTIONS, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.token = None
 
         self._debtors_loaded = False
         self._debtors_rows = []
         self._debtors_by_vat = {}
+        self._debtors_by_account = {}
+        self._debtor_index_version = None
+        self._debtor_map = None
+        self._debtor_fps = {}
+        self.debtor_sync_mode = UNICONTA_DEBTOR_SYNC
+        self.debtor_index_stats = {}
+
+        self._orders_loaded = False
+        self._orders_by_account = {}
+        self._order_insert_lock = threading.Lock()
+        # accounts prepare_orders could not create an order for (their invoices are reported)
+        self._order_failed_accounts = set()
+
+        self.customerDataBase = []
+        # callable returning a freshly synced customer list, used once by refresh_customers
+        self.customer_resync = None
 
         self._login()
 
+    @property
+    def customerDataBase(self) -> list:
+        return self._customer_database
+
+    @customerDataBase.setter
+    def customerDataBase(self, customers: list) -> None:
+        # the index is rebuilt on every assignment, lookups go through customer_index
+        self._customer_database = customers
+        self.customer_index = CustomerIndex(customers)
+
+    def refresh_customers(self) -> bool:
+        """Run customer_resync once, for a customer id missing from the snapshot. True when it ran."""
+        resync, self.customer_resync = self.customer_resync, None
+        if resync is None:
+            return False
+        self.customerDataBase = resync()
+        return True
+
     def _login(self):
         payload = {
             "Username": self._username,
@@ -70,82 +131,256 @@ class UnicontaClient:
         resp.raise_for_status()
         return resp
 
-    def get_order_lines_by_order_number(self, order_number: str,) -> List[Dict[str, Any]]:
-        return
+    def get_order_lines_by_order_number(self, order_number: str, reference_number: str = "API_TEST") -> List[Dict[str, Any]]:
+        """Order lines posted by this tool (ReferenceNumber) on one order."""
         payload = [
             {
-                "PropertyName": "OrderNumber","FilterValue": order_number,
+                "PropertyName": "OrderNumber","FilterValue": str(order_number),
                 "Skip": 0,"Take": 0,
                 "OrderBy": "true","OrderByDescending": "false",
             }
         ]
 
-        response = self._post("Query/Get/DebtorOrderLineClient", json=payload)
-        if response.ok:
-            dictlist =response.json()
-
+        response = self._post("Query/Get/DebtorOrderLineClientUser", json=payload)
+        dictlist = response.json() or []
+        return [
+            row for row in dictlist
+            if str(row.get("OrderNumber")) == str(order_number)
+            and row.get("ReferenceNumber") == reference_number
+        ]
 
     def _ensure_login(self):
         if not self.token:
             self._login()
 
-    def _load_debtors_cache(self):
+    @staticmethod
+    def _is_id_field(key: str) -> bool:
+        key_l = key.lower()
+        return any(t in key_l for t in ["vat", "cvr", "regno"]) or key_l == "account"
+
+    @staticmethod
+    def _is_vat_field(key: str) -> bool:
+        """ID fields a CloudFactory VAT is matched against: the ID fields minus codes like VatZone."""
+        return UnicontaClient._is_id_field(key) and "zone" not in key.lower()
+
+    def _iter_debtor_pages(self, page_size: int = 0, property_name: str = "Account", filter_value: str = ""):
         """
-        Load all debtors from Uniconta once and build an index of ID-like values:
-        any field whose key contains 'vat', 'cvr', 'regno' OR is exactly 'Account'
-        is treated as an ID / VAT container.
+        Yield DebtorClient rows page by page (Skip/Take), so a page can be indexed and dropped.
+        Pages are always ordered by Account: filtering on a non-unique field (fx the modified
+        date) gives no stable order between pages, and rows would be skipped or repeated.
         """
-        if self._debtors_loaded:
-            return
+        page_size = page_size or UNICONTA_QUERY_PAGE_SIZE
+        url = f"{self.base_url}Query/Get/DebtorClient"
 
-        #print("[DEBUG] _load_debtors_cache: loading all DebtorClient rows from Uniconta...")
+        skip = 0
+        while True:
+            payload = [
+                {
+                    "PropertyName": property_name,
+                    "FilterValue": filter_value,
+                    "Skip": skip,
+                    "Take": page_size,
+                    "OrderBy": "true" if property_name == "Account" else "false",
+                    "OrderByDescending": "false",
+                }
+            ]
+            if property_name != "Account":
+                payload.append({
+                    "PropertyName": "Account",
+                    "FilterValue": "",
+                    "Skip": skip,
+                    "Take": page_size,
+                    "OrderBy": "true",
+                    "OrderByDescending": "false",
+                })
+
+            resp = self.session.post(url, json=payload)
+            if not resp.ok:
+                raise RuntimeError(f"_load_debtors_cache failed: {resp.status_code} {resp.text}")
 
-        url = f"{self.base_url}Query/Get/DebtorClient"
+            page = resp.json() or []
+            yield page
+            if len(page) < page_size:
+                return
+            skip += page_size
 
-        payload = [
-            {
-                "PropertyName": "Account",
-                "FilterValue": "",
-                "Skip": 0,
-                "Take": 0,
-                "OrderBy": "true",
-                "OrderByDescending": "false",
-            }
-        ]
+    def _project_debtor_rows(self, pages):
+        """
+        Keep only DEBTOR_FIELDS and the ID-like fields of each row: any field whose key
+        contains 'vat', 'cvr', 'regno' OR is exactly 'Account'.
+        """
+        # key -> is it an ID field; rows share the same handful of keys
+        id_fields = {}
+        for page in pages:
+            for raw in page:
+                row = {}
+                for key, val in raw.items():
+                    is_id = id_fields.get(key)
+                    if is_id is None:
+                        is_id = id_fields[key] = self._is_id_field(key)
+                    if is_id or key in DEBTOR_FIELDS or key == UNICONTA_DEBTOR_MODIFIED_FIELD:
+                        row[key] = val
+                yield row
+
+    def _index_debtor_rows(self, rows) -> dict:
+        """
+        Index the debtors under every customer VAT that should find them, so a customer
+        resolves with one lookup on its normalized VAT (see _lookup_debtor).
+        key -> [(rank, cc, row)], sorted by rank and then row order. A debtor value d is
+        found by a customer VAT v (normalized) with country code cc when, best rank first:
+          0. v == d
+          1. cc + v == d                (d = two letters + the rest; only for that cc)
+          2. v zero-padded to 8 == d    (Danish CVR stored with leading zeros)
+          3. cc + v zero-padded to 8 == d
+        cc "" means any country.
+        """
+        by_vat = {}
+        vat_fields = {}
+        for pos, row in enumerate(rows):
+            entries = set()
+            for key, val in row.items():
+                is_vat = vat_fields.get(key)
+                if is_vat is None:
+                    is_vat = vat_fields[key] = self._is_vat_field(key)
+                if is_vat and val is not None:
+                    entries.update(self._debtor_vat_keys(self._normalize_vat(str(val))))
+            for rank, cc, key in entries:
+                by_vat.setdefault(key, []).append((rank, pos, cc, row))
+
+        return {
+            key: [(rank, cc, row) for rank, _, cc, row in sorted(matches, key=lambda m: (m[0], m[1]))]
+            for key, matches in by_vat.items()
+        }
 
-        resp = self.session.post(url, json=payload)
-        if not resp.ok:
-            raise RuntimeError(f"_load_debtors_cache failed: {resp.status_code} {resp.text}")
+    @staticmethod
+    def _debtor_vat_keys(value: str) -> list[tuple]:
+        """(rank, cc, key) entries for one normalized debtor value, see _index_debtor_rows."""
+        if not value:
+            return []
 
-        data = resp.json() or []
-        self._debtors_rows = data
+        def unpadded(digits):
+            # the shorter customer VATs that zero-pad to these 8 digits
+            return [digits[k:] for k in range(1, 8) if digits[:k] == "0" * k]
 
-        by_vat = {}
+        keys = [(0, "", value)]
+        if value.isdigit() and len(value) == 8:
+            keys += [(2, "", v) for v in unpadded(value)]
+        cc, rest = value[:2], value[2:]
+        if rest and cc.isalpha():
+            keys.append((1, cc, rest))
+            if rest.isdigit() and len(rest) == 8:
+                keys += [(3, cc, v) for v in unpadded(rest)]
+        return keys
 
-        for row in data:
-            vat_values = set()
-            for key, val in row.items():
-                if val is None:
-                    continue
-                key_l = key.lower()
-                if (
-                    any(t in key_l for t in ["vat", "cvr", "regno"])
-                    or key_l == "account"
-                ):
-                    vat_values.add(str(val))
-
-            for raw_vat in vat_values:
-                norm_vat = self._normalize_vat(raw_vat)
-                if norm_vat:
-                    by_vat.setdefault(norm_vat, []).append(row)
+    def _load_debtors_cache(self):
+        """
+        Load all debtors from Uniconta once and build an index of ID-like values.
+        The index is kept on disk (DebtorIndexSnapshot); debtor_sync_mode decides how it is used:
+          - "auto"     → use the snapshot while it is younger than the TTL, else "delta"
+          - "snapshot" → use the snapshot as is (only fetch if there is none)
+          - "delta"    → fetch only debtors modified since the snapshot and merge them
+          - "full"     → fetch every debtor page by page and rebuild
+        auto and delta turn into "full" when the last full load is older than
+        DEBTOR_INDEX_FULL_HOURS, so debtors deleted in Uniconta drop out.
+        """
+        if self._debtors_loaded:
+            return
+
+        mode = self.debtor_sync_mode
+        if mode not in DEBTOR_SYNC_MODES:
+            raise ValueError(f"debtor_sync_mode skal være en af {DEBTOR_SYNC_MODES}")
 
+        start = time.perf_counter()
+        snapshot_store = DebtorIndexSnapshot()
+        snapshot = None if mode == "full" else snapshot_store.load(self.base_url)
+
+        if snapshot is None or (mode in ("auto", "delta") and snapshot_store.needs_full(snapshot["full_synced_at"])):
+            mode = "full"
+        elif mode == "auto":
+            mode = "snapshot" if snapshot_store.is_fresh(snapshot["synced_at"]) else "delta"
+
+        synced_at = time.time()
+        changed = 0
+        if mode == "snapshot":
+            rows, by_vat = snapshot["rows"], snapshot["by_vat"]
+            synced_at = snapshot["synced_at"]
+        else:
+            rows = None
+            if mode == "delta":
+                rows, changed = self._delta_debtor_rows(snapshot)
+                if rows is None:
+                    mode = "full"
+            if mode == "full":
+                rows = list(self._project_debtor_rows(self._iter_debtor_pages()))
+                changed = len(rows)
+            by_vat = self._index_debtor_rows(rows)
+            full_synced_at = synced_at if mode == "full" else snapshot["full_synced_at"]
+            snapshot_store.save(self.base_url, rows, by_vat, synced_at, self._latest_modified(rows), full_synced_at)
+
+        self._debtors_rows = rows
         self._debtors_by_vat = by_vat
+        self._debtors_by_account = {self._account_key(row.get("Account")): row for row in rows}
+        self._debtor_index_version = synced_at
+        self._debtor_fps = {}
+        if self._debtor_map is None:
+            self._debtor_map = CustomerDebtorMap(self.base_url)
         self._debtors_loaded = True
 
-        #print(
-        #    f"[DEBUG] _load_debtors_cache: loaded {len(self._debtors_rows)} debtors, "
-         #   f"{len(self._debtors_by_vat)} distinct ID/VAT keys (VatNumber/CompanyRegNo/Account)."
-        #)
+        self.debtor_index_stats = {
+            "source": mode,
+            "debtors": len(rows),
+            "keys": len(by_vat),
+            "changed": changed,
+            "build_seconds": round(time.perf_counter() - start, 2),
+            "age_seconds": round(time.time() - synced_at, 1),
+        }
+        print(
+            f"Uniconta debtor index ({mode}): {len(rows)} debtors, {len(by_vat)} ID/VAT keys, "
+            f"{changed} fetched, {self.debtor_index_stats['build_seconds']:.1f}s, "
+            f"{self.debtor_index_stats['age_seconds'] / 3600:.1f}h old"
+        )
+
+    def _delta_debtor_rows(self, snapshot):
+        """
+        Merge debtors modified since the snapshot (UNICONTA_DEBTOR_MODIFIED_FIELD) into its rows.
+        Returns (rows, changed), or (None, 0) when Uniconta can't filter on that field.
+        Deleted debtors are only dropped by a full load, see DEBTOR_INDEX_FULL_HOURS.
+        """
+        # the newest modified time Uniconta itself reported; without it, the local sync
+        # time in UTC with a small overlap so changes made during the last sync are not missed
+        since = snapshot.get("server_modified") or datetime.fromtimestamp(
+            snapshot["synced_at"] - 300, timezone.utc
+        ).strftime(UNICONTA_TIME_FORMAT)
+        try:
+            changed_rows = list(self._project_debtor_rows(
+                self._iter_debtor_pages(property_name=UNICONTA_DEBTOR_MODIFIED_FIELD, filter_value=f"{since}..")
+            ))
+        except (RuntimeError, requests.RequestException) as e:
+            print(f"Delta load of debtors failed, loading all: {e}")
+            return None, 0
+
+        by_account = {self._account_key(row.get("Account")): row for row in snapshot["rows"]}
+        for row in changed_rows:
+            by_account[self._account_key(row.get("Account"))] = row
+        return list(by_account.values()), len(changed_rows)
+
+    @staticmethod
+    def _latest_modified(rows) -> Optional[str]:
+        """Newest UNICONTA_DEBTOR_MODIFIED_FIELD among rows, as UTC in UNICONTA_TIME_FORMAT (None if absent)."""
+        latest = None
+        for row in rows:
+            value = row.get(UNICONTA_DEBTOR_MODIFIED_FIELD)
+            if not value:
+                continue
+            try:
+                modified = datetime.fromisoformat(str(value))
+            except ValueError:
+                continue
+            if modified.tzinfo is not None:
+                modified = modified.astimezone(timezone.utc).replace(tzinfo=None)
+            if latest is None or modified > latest:
+                latest = modified
+        return latest.strftime(UNICONTA_TIME_FORMAT) if latest else None
 
     @staticmethod
     def _normalize_vat(value: str | None) -> str:
@@ -163,136 +398,279 @@ class UnicontaClient:
         s = s.replace(" ", "").replace(".", "").replace("-", "")
         return s.upper()
 
-    @staticmethod
-    def _candidate_vat_values(customer) -> list[str]:
+    def _lookup_debtor(self, customer):
+        """Best ranked debtor row indexed under the customer's normalized VAT, or None."""
+        vat = self._normalize_vat(customer.vatID)
+        if not vat:
+            return None
+
+        cc = (customer.countryCode or "").strip().upper()
+        for rank, debtor_cc, row in self._debtors_by_vat.get(vat, ()):
+            if not debtor_cc or debtor_cc == cc:
+                return row
+        return None
+
+    def _match_debtor(self, invoice, context):
         """
-        Build a list of possible VAT/ID formats from CloudFactory VAT
-        to try against the unified index (VatNumber, CompanyRegNo, Account).
-        We do NOT use Name for matching.
+        Debtor row matching the invoice customer's VAT/ID, or None. Does not report.
+        Matches are memoised per run on context.debtor_matches, and per Customer.id across
+        runs by the CustomerDebtorMap (see _mapped_or_lookup).
         """
-        candidates = set()
+        if not invoice.customer or invoice.customer.vatID is None:
+            return None
 
-        raw = str(customer.vatID or "").strip()
-        if not raw:
-            return []
+        self._load_debtors_cache()
 
-        # Raw
-        candidates.add(raw)
+        customer = invoice.customer
+        memo = context.debtor_matches
+        memo_key = (self.base_url, self._debtor_index_version, customer.id, customer.vatID, customer.countryCode)
+        if memo_key not in memo:
+            memo[memo_key] = self._mapped_or_lookup(customer)
+        return memo[memo_key]
 
-        # Cleaned
-        cleaned = raw.replace(" ", "").replace(".", "").replace("-", "")
-        candidates.add(cleaned)
+    def _mapped_or_lookup(self, customer):
+        """
+        Use the stored customer -> debtor link (CustomerDebtorMap) while neither the
+        customer's VAT data nor the debtor row changed; otherwise match by VAT again
+        and store the new result.
+        """
+        if customer.id is None:
+            return self._lookup_debtor(customer)
+
+        debtor_map = self._debtor_map
+        customer_fp = debtor_map.customer_fingerprint(customer)
+        entry = debtor_map.get(customer.id)
+        if entry is not None and entry["method"] == DEBTOR_MATCH_METHOD and entry["customer_fp"] == customer_fp:
+            row = self._debtors_by_account.get(self._account_key(entry["account"]))
+            if row is not None and entry["debtor_fp"] == self._debtor_fingerprint(row):
+                return row
+
+        row = self._lookup_debtor(customer)
+        if row is not None:
+            debtor_map.put(customer, row.get("Account"), DEBTOR_MATCH_METHOD, customer_fp, self._debtor_fingerprint(row))
+        elif entry is not None:
+            debtor_map.forget(customer.id)
+        return row
+
+    def _debtor_fingerprint(self, row):
+        # once per debtor row and index load; reset in _load_debtors_cache
+        key = self._account_key(row.get("Account"))
+        fp = self._debtor_fps.get(key)
+        if fp is None:
+            fp = self._debtor_fps[key] = self._debtor_map.debtor_fingerprint(row)
+        return fp
+
+    def close(self):
+        if self._debtor_map is not None:
+            self._debtor_map.close()
+            self._debtor_map = None
+
+    def find_deptor_from_invoice(self, invoice, context):
+        deptor = self._match_debtor(invoice, context)
+        if deptor is None:
+            report_success_or_failure(context, invoice, False)
+        return deptor
 
-        # Prefix with country code if available
-        cc = (customer.countryCode or "").strip()
-        if cc:
-            candidates.add(cc + cleaned)
-            candidates.add(cc.upper() + cleaned)
+    def _load_orders_cache(self):
+        """
+        Load all open DebtorOrderClient rows once and index them by Account,
+        so find_orderNumber does not need a query per debtor.
+        """
+        if self._orders_loaded:
+            return
 
-        # If looks numeric, consider zero-padded (e.g. Danish CVR 8 digits)
-        if cleaned.isdigit() and len(cleaned) < 10:
-            padded = cleaned.zfill(8)
-            candidates.add(padded)
-            if cc:
-                candidates.add(cc + padded)
-                candidates.add(cc.upper() + padded)
+        payload = [
+            {
+                "PropertyName": "Account", "FilterValue": "",
+                "Skip": 0, "Take": 0,
+                "OrderBy": "true", "OrderByDescending": "false",
+            }
+        ]
+        resp = self._post("Query/Get/DebtorOrderClient", json=payload)
 
-        return list(candidates)
+        by_account = {}
+        for row in resp.json() or []:
+            by_account.setdefault(self._account_key(row.get("Account")), []).append(row)
 
-    def find_deptor_from_invoice(self, invoice):
-        if not invoice.customer or invoice.customer.vatID is None:
-            report_success_or_failure(invoice, False)
-            return None
+        self._orders_by_account = by_account
+        self._orders_loaded = True
 
-        self._load_debtors_cache()
+    def _refresh_orders_for_accounts(self, accounts):
+        """
+        Re-query only the given accounts (fx after an insert) and update the order index.
+        The accounts are sent as one ";" separated filter per UNICONTA_ORDER_INSERT_CHUNK
+        accounts; an account that filter returned no order for is asked for on its own.
+        """
+        keys = list(dict.fromkeys(self._account_key(account) for account in accounts))
+        found = {}
+        for i in range(0, len(keys), UNICONTA_ORDER_INSERT_CHUNK):
+            chunk = set(keys[i:i + UNICONTA_ORDER_INSERT_CHUNK])
+            for row in self._query_orders(";".join(keys[i:i + UNICONTA_ORDER_INSERT_CHUNK])):
+                key = self._account_key(row.get("Account"))
+                if key in chunk:
+                    found.setdefault(key, []).append(row)
+
+        for key in keys:
+            if key not in found and len(keys) > 1:
+                found[key] = [row for row in self._query_orders(key) if self._account_key(row.get("Account")) == key]
+            self._orders_by_account[key] = found.get(key, [])
+
+    def _query_orders(self, account_filter: str) -> list:
+        payload = [
+            {
+                "PropertyName": "Account", "FilterValue": account_filter,
+                "Skip": 0, "Take": 0,
+                "OrderBy": "true", "OrderByDescending": "false",
+            }
+        ]
+        return self._post("Query/Get/DebtorOrderClient", json=payload).json() or []
 
-        candidates = self._candidate_vat_values(invoice.customer)
-        if not candidates:
-            report_success_or_failure(invoice, False)
+    @staticmethod
+    def _account_key(account) -> str:
+        return str(account).strip()
 
-            return None
+    @staticmethod
+    def _order_payload(debtor, invoice) -> dict:
+        landCode = debtor.get("Currency")
+        if not landCode:
+            landCode = "DKK"
+
+        return {
+            "Account": int(debtor.get("Account")),
+            "Layout group": "Flexfone",
+            "LayoutGroup": "Flexfone",
+            "Currency": landCode,
+            "Account Name": debtor.get("Account Name"),
+            "YourRef": "API-ORDER-001",
+            "invoice_date": invoice.period_end
+        }
 
-        norm_candidates = [self._normalize_vat(c) for c in candidates if c]
-        matchesFound = []
+    def debtors(self) -> list:
+        """All debtor rows (projected, see DEBTOR_FIELDS), loading the index if needed."""
+        self._load_debtors_cache()
+        return self._debtors_rows
 
-        for nc in norm_candidates:
-            if not nc:
+    def preload(self):
+        """Load the debtor and order indexes up front, before the order lines are built."""
+        self._ensure_login()
+        self._load_debtors_cache()
+        self._load_orders_cache()
+
+    def prepare_orders(self, invoices, context, chunk_size: int = 0) -> int:
+        """
+        Create an order for every matched debtor that has none yet, using
+        Crud/InsertList/DebtorOrderClient in chunks, then resolve the new
+        OrderNumbers by querying only the inserted accounts.
+        A chunk Uniconta rejects (fx a debtor deleted there since the index was
+        saved) is retried order by order; the invoices of accounts that still
+        fail are reported as failed and not posted.
+        Returns the number of orders created.
+        """
+        chunk_size = chunk_size or UNICONTA_ORDER_INSERT_CHUNK
+        self._load_orders_cache()
+
+        missing = {}
+        invoices_by_account = {}
+        skipped = set()
+        for invoice in invoices:
+            debtor = self._match_debtor(invoice, context)
+            if debtor is None:
                 continue
-            matches = self._debtors_by_vat.get(nc)
-            if matches:
-                matchesFound = matches
-                break
+            key = self._account_key(debtor.get("Account"))
+            if key in skipped or self._orders_by_account.get(key):
+                continue
+            if key not in missing:
+                try:
+                    missing[key] = self._order_payload(debtor, invoice)
+                except (TypeError, ValueError):
+                    # non-numeric account, find_orderNumber will report it per invoice
+                    print(f"Skipping order for account {key}: not a numeric account")
+                    skipped.add(key)
+                    continue
+            invoices_by_account.setdefault(key, []).append(invoice)
 
-        if matchesFound is None or len(matchesFound) < 1:
-            report_success_or_failure(invoice, False)
-            return None
+        if not missing:
+            return 0
 
-        deptor = matchesFound[0]
-        return deptor
+        keys = list(missing)
+        failed = []
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            if self._insert_orders([missing[key] for key in chunk]):
+                continue
+            # the rest of the chunk may have been stored anyway, only retry accounts without an order
+            self._refresh_orders_for_accounts(chunk)
+            for key in chunk:
+                if not self._orders_by_account.get(key) and not self._insert_orders([missing[key]]):
+                    failed.append(key)
+
+        if failed:
+            print(f"Could not create orders for accounts: {', '.join(failed)}")
+            for key in failed:
+                self._order_failed_accounts.add(key)
+                for invoice in invoices_by_account[key]:
+                    report_success_or_failure(context, invoice, False)
+
+        self._refresh_orders_for_accounts([key for key in missing if key not in failed])
+
+        unresolved = [key for key in missing if key not in failed and not self._orders_by_account.get(key)]
+        if unresolved:
+            print(f"No order found after insert for accounts: {', '.join(unresolved)}")
+
+        created = len(missing) - len(failed) - len(unresolved)
+        print(f"Created {created} orders in {-(-len(keys) // chunk_size)} requests")
+        return created
+
+    def _insert_orders(self, payloads) -> bool:
+        """One Crud/InsertList/DebtorOrderClient call; False (printed) instead of raising when it fails."""
+        try:
+            resp = self.session.post(f"{self.base_url}Crud/InsertList/DebtorOrderClient", json=payloads)
+        except requests.RequestException as e:
+            print(f"Order insert of {len(payloads)} orders failed: {e}")
+            return False
+        if not resp.ok:
+            print(f"Order insert of {len(payloads)} orders failed: {resp.status_code} {resp.text[:200]}")
+            return False
+        return True
 
     def find_orderNumber(self, debtor, invoice):
         OrderNumber = None
         accountname = debtor.get("Account", "None")
-        payload = [
-            {
-                "PropertyName": "Account","FilterValue": accountname,
-                "Skip": 0,"Take": 0,
-                "OrderBy": "true","OrderByDescending": "false",
-            }
-        ]
-        resp = self._post("Query/Get/DebtorOrderClient", json=payload)
-        data = resp.json()
-
-        if type(data)!=type(list)and len(data) == 0:
-
-            landCode = debtor.get("Currency")
-            if not landCode:
-                landCode = "DKK"
-
-            payload = {
-                "Account": int(debtor.get("Account")),
-                "Layout group": "Flexfone",
-                "LayoutGroup": "Flexfone",
-                "Currency": landCode,
-                "Account Name": debtor.get("Account Name"),
-                "YourRef": "API-ORDER-001",
-                "invoice_date": invoice.period_end
-            }
 
-            resp =  self._post("Crud/Insert/DebtorOrderClient", json=payload)
-            data = resp.json()
-            if not resp.ok:
-                raise RuntimeError(f"ERP create_invoice failed: {resp.status_code} {resp.text}")
-
-            if type(data)!=type(list):
-                payload = [
-                    {
-                        "PropertyName": "Account", "FilterValue": accountname,
-                        "Skip": 0, "Take": 0,
-                        "OrderBy": "true", "OrderByDescending": "false",
-                    }
-                ]
-
-                resp = self._post("Query/Get/DebtorOrderClient", json=payload)
-                data = resp.json()
-                if not resp.ok:
-                    raise RuntimeError(f"ERP create_invoice failed: {resp.status_code} {resp.text}")
-            if type(data)==type(list) and len(data) == 0:
-                raise RuntimeError(f"ERP create_invoice failed: {resp.status_code} {resp.text}")
-            else:
-                OrderNumber = data[0].get("OrderNumber") or data[0].get("invoiceNumber")
-        else:
-            OrderNumber = data[0].get("OrderNumber") or data[0].get("invoiceNumber")
+        self._load_orders_cache()
+        orders = self._orders_by_account.get(self._account_key(accountname))
+
+        if not orders:
+            with self._order_insert_lock:
+                # another posting thread may have created it meanwhile
+                orders = self._orders_by_account.get(self._account_key(accountname))
+                if not orders:
+                    resp = self._post("Crud/Insert/DebtorOrderClient", json=self._order_payload(debtor, invoice))
+                    if not resp.ok:
+                        raise RuntimeError(f"ERP create_invoice failed: {resp.status_code} {resp.text}")
+
+                    self._refresh_orders_for_accounts([accountname])
+                    orders = self._orders_by_account.get(self._account_key(accountname))
+                    if not orders:
+                        raise RuntimeError(f"ERP create_invoice failed: no order found for account {accountname} after insert")
+
+        OrderNumber = orders[0].get("OrderNumber") or orders[0].get("invoiceNumber")
         if OrderNumber == "Invalid" or OrderNumber == None:
             print("order number not found")
 
         return OrderNumber
 
-    def create_uniconta_order_with_lines(self, invoice: CustomerInvoice) -> str:
-        error = ""
-        deptor = self.find_deptor_from_invoice(invoice)
+    def build_order_lines(self, invoice: CustomerInvoice, context):
+        """
+        Resolve debtor and order for the invoice and build its DebtorOrderLineClientUser rows.
+        Returns (lines, error); lines is None when the invoice can't be posted (already reported).
+        """
+        deptor = self.find_deptor_from_invoice(invoice, context)
         if deptor is None:
-            return "Could not find deptor for invoice"
+            return None, "Could not find deptor for invoice"
+        if self._account_key(deptor.get("Account")) in self._order_failed_accounts:
+            # reported by prepare_orders
+            return None, "Could not create order for debtor"
         OrderNumber = self.find_orderNumber(deptor, invoice)
         all_lines = []
         currencyCode = deptor.get("Currency", "DKK")
@@ -317,8 +695,13 @@ class UnicontaClient:
                         "Text": str(catline.ItemName),
                         "Qty": catline.Quantity,
                     })
-        response = self._post("Crud/InsertList/DebtorOrderLineClientUser", json=all_lines)
-        report_success_or_failure(invoice, response.ok)
+        return all_lines, ""
+
+    def post_order_lines(self, lines, timeout=None):
+        """Insert order lines and return the response without raising, the caller decides on retries."""
+        url = f"{self.base_url}Crud/InsertList/DebtorOrderLineClientUser"
+        return self.session.post(url, json=lines, timeout=timeout)
+
 
 
 @dataclass
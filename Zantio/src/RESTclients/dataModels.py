@@ -44,6 +44,22 @@ class Customer:
         return self.countryCode+self.vatID
 
 
+class CustomerIndex:
+    """CloudFactory customers bucketed by lower-cased id, so billing rows resolve in O(1)."""
+
+    def __init__(self, customers=None):
+        self._by_id: Dict[str, list] = {}
+        for customer in customers or []:
+            self._by_id.setdefault(customer.id.lower(), []).append(customer)
+
+    def find(self, customer_id: str) -> list:
+        """All customers with this id; more than one means the id is ambiguous."""
+        return self._by_id.get(customer_id.lower(), [])
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+
 @dataclass
 class CustomerInvoiceCategoryLineBase:
     ProductFamily: str
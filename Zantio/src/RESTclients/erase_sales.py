@@ -15,46 +15,227 @@ Begge flows understøtter dry-run.
 """
 
 from dotenv import load_dotenv
+import os
 import sys
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
 
-from RESTclients.Uniconta.uniconta import UnicontaClient
+import requests
+
+from RESTclients.Uniconta.uniconta import UnicontaClient, UNICONTA_QUERY_PAGE_SIZE
+from RESTclients.Uniconta.posting_journal import PostingJournal
+from RESTclients.Uniconta.line_batcher import UNICONTA_LINE_TIMEOUT
 
 
 # ------------------------------------------------------------------
-# ORDRE-NIVEAU (DebtorOrderClient)
+# QUERY (server-side filter + paging)
 # ------------------------------------------------------------------
 
-def fetch_debtor_orders(
+ERASE_PAGE_SIZE = UNICONTA_QUERY_PAGE_SIZE
+
+
+def _query_paged(
     adapter: UnicontaClient,
-    your_ref: str,
+    table: str,
+    property_name: str,
+    filter_value: str,
+    order_by: str,
+    page_size: int = 0,
 ) -> List[dict]:
     """
-    Henter alle DebtorOrderClient og filtrerer på YourRef.
+    Henter rækker fra Query/Get/<table> hvor Uniconta selv filtrerer på
+    property_name = filter_value, side for side med Skip/Take.
+    Siderne sorteres på order_by, der skal være unik (fx OrderNumber/RowId);
+    filter-feltet er ens for alle rækker og giver ingen fast rækkefølge mellem
+    sider. Alle sider hentes før der slettes noget, så Skip ikke forskydes.
     """
-    url = f"{adapter.base_url}/Query/Get/DebtorOrderClient"
-
-    payload = [
-        {
-            "PropertyName": "Account",
-            "FilterValue": "",
-            "Skip": 0,
-            "Take": 0,
-            "OrderBy": "true",
-            "OrderByDescending": "false",
-        }
-    ]
+    page_size = page_size or ERASE_PAGE_SIZE
+    url = f"{adapter.base_url}/Query/Get/{table}"
+
+    rows = []
+    seen = set()
+    skip = 0
+    while True:
+        payload = [
+            {
+                "PropertyName": property_name,
+                "FilterValue": filter_value,
+                "Skip": skip,
+                "Take": page_size,
+                "OrderBy": "false",
+                "OrderByDescending": "false",
+            },
+            {
+                "PropertyName": order_by,
+                "FilterValue": "",
+                "Skip": skip,
+                "Take": page_size,
+                "OrderBy": "true",
+                "OrderByDescending": "false",
+            },
+        ]
+
+        resp = adapter.session.post(url, json=payload)
+        if not resp.ok:
+            raise RuntimeError(
+                f"Query/Get/{table} failed: {resp.status_code} {resp.text}"
+            )
+
+        page = resp.json() or []
+        for row in page:
+            key = row.get(order_by)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            rows.append(row)
+        if len(page) < page_size:
+            return rows
+        skip += page_size
+
+
+# ------------------------------------------------------------------
+# DELETE (chunks, begrænset parallelitet, retry)
+# ------------------------------------------------------------------
 
-    resp = adapter.session.post(url, json=payload)
-    if not resp.ok:
-        raise RuntimeError(
-            f"Query/Get/DebtorOrderClient failed: {resp.status_code} {resp.text}"
+ERASE_DELETE_CHUNK = int(os.getenv("UNICONTA_DELETE_CHUNK", "100"))
+ERASE_DELETE_WORKERS = int(os.getenv("UNICONTA_DELETE_WORKERS", "4"))
+ERASE_DELETE_RETRIES = int(os.getenv("UNICONTA_DELETE_RETRIES", "3"))
+# samme timeout som linje-inserts; uden den hænger et kald for evigt og retry når aldrig frem
+ERASE_DELETE_TIMEOUT = UNICONTA_LINE_TIMEOUT
+
+
+@dataclass
+class DeleteSummary:
+    table: str
+    requested: int
+    deleted: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    errors: List[str] = field(default_factory=list)
+    deleted_rows: List[dict] = field(default_factory=list, repr=False)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.deleted / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.table}: slettede {self.deleted} af {self.requested}, "
+            f"{self.failed} fejlede, {self.seconds:.1f}s ({self.rows_per_second:.0f} rækker/s)"
         )
 
-    data = resp.json() or []
+
+def _still_present(adapter: UnicontaClient, table: str, rows: List[dict], key_field: str) -> Optional[List[dict]]:
+    """
+    De af rows der stadig findes i Uniconta, slået op pr. OrderNumber (begge tabeller har det)
+    og sammenlignet på key_field. None hvis opslaget fejler - så vides intet.
+    """
+    present = set()
+    try:
+        for order_number in {row.get("OrderNumber") for row in rows}:
+            for row in _query_paged(adapter, table, "OrderNumber", str(order_number), order_by=key_field):
+                if str(row.get("OrderNumber")) == str(order_number):
+                    present.add(row.get(key_field))
+    except (RuntimeError, requests.RequestException) as e:
+        print(f"Kunne ikke tjekke {table} efter fejlet sletning: {e}")
+        return None
+    # rækker uden nøgle kan ikke tjekkes og regnes som ikke slettet
+    return [row for row in rows if row.get(key_field) is None or row.get(key_field) in present]
+
+
+def _delete_chunked(
+    adapter: UnicontaClient,
+    table: str,
+    rows: List[dict],
+    key_field: str,
+    chunk_size: int = 0,
+    workers: int = 0,
+    retries: int = 0,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> DeleteSummary:
+    """
+    Sletter rows via Crud/DeleteList/<table> i chunks, med op til workers
+    samtidige kald. Et chunk der fejler prøves igen op til retries gange.
+    Efter en timeout eller 5xx kan kaldet være gået igennem alligevel, så der
+    slås op hvilke rækker (key_field) der stadig findes; kun de sendes igen,
+    og kun de tælles som fejlet.
+    progress(behandlede, total) kaldes efter hvert chunk (fra den kaldende tråd).
+    """
+    chunk_size = chunk_size or ERASE_DELETE_CHUNK
+    workers = max(1, workers or ERASE_DELETE_WORKERS)
+    retries = retries or ERASE_DELETE_RETRIES
+    url = f"{adapter.base_url}/Crud/DeleteList/{table}"
+
+    def delete_chunk(chunk):
+        """Returnerer (chunk, slettede rækker, fejlede rækker, fejltekst)."""
+        remaining = chunk
+        error = ""
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                resp = adapter.session.delete(url, json=remaining, timeout=ERASE_DELETE_TIMEOUT)
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if resp.ok:
+                    return chunk, chunk, [], ""
+                error = f"{resp.status_code} {resp.text[:200]}"
+                if resp.status_code < 500 and resp.status_code not in (408, 429):
+                    break
+
+            # svaret siger ikke om Uniconta nåede at slette; send kun det der stadig findes
+            present = _still_present(adapter, table, remaining, key_field)
+            if present is not None:
+                remaining = present
+            if not remaining:
+                return chunk, chunk, [], ""
+
+        failed_ids = {id(row) for row in remaining}
+        return chunk, [row for row in chunk if id(row) not in failed_ids], remaining, error
+
+    summary = DeleteSummary(table=table, requested=len(rows))
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    done = 0
+
+    start = time.perf_counter()
+    if progress:
+        progress(0, len(rows))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(delete_chunk, chunk) for chunk in chunks]):
+            chunk, deleted, failed, error = future.result()
+            if failed:
+                summary.failed += len(failed)
+                summary.errors.append(error)
+            summary.deleted += len(deleted)
+            summary.deleted_rows.extend(deleted)
+            done += len(chunk)
+            if progress:
+                progress(done, len(rows))
+    summary.seconds = time.perf_counter() - start
+
+    return summary
+
+
+# ------------------------------------------------------------------
+# ORDRE-NIVEAU (DebtorOrderClient)
+# ------------------------------------------------------------------
+
+def fetch_debtor_orders(
+    adapter: UnicontaClient,
+    your_ref: str,
+) -> List[dict]:
+    """
+    Henter DebtorOrderClient med YourRef = your_ref (filtreret i Uniconta).
+    """
+    data = _query_paged(adapter, "DebtorOrderClient", "YourRef", your_ref or "", order_by="OrderNumber")
+    # Uniconta-filteret kan matche bredere end lighed, så der tjekkes eksakt her
     filtered = [row for row in data if row.get("YourRef") == your_ref]
 
-    print(f"🔍 DebtorOrderClient total: {len(data)}")
+    print(f"🔍 DebtorOrderClient hentet: {len(data)}")
     print(f"🔎 Matcher YourRef='{your_ref}': {len(filtered)}")
 
     return filtered
@@ -63,23 +244,22 @@ def fetch_debtor_orders(
 def delete_debtor_orders(
     adapter: UnicontaClient,
     orders: List[dict],
-):
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> DeleteSummary:
     """
-    Sletter DebtorOrderClient-ordrer.
+    Sletter DebtorOrderClient-ordrer i chunks.
     """
     if not orders:
         print("✅ Ingen ordrer at slette.")
-        return
+        return DeleteSummary(table="DebtorOrderClient", requested=0)
 
-    url = f"{adapter.base_url}/Crud/DeleteList/DebtorOrderClient"
-    resp = adapter.session.delete(url, json=orders)
+    summary = _delete_chunked(adapter, "DebtorOrderClient", orders, key_field="OrderNumber", progress=progress)
 
-    if not resp.ok:
-        raise RuntimeError(
-            f"DeleteList/DebtorOrderClient failed: {resp.status_code} {resp.text}"
-        )
-
-    print(f"🗑️  Slettede {len(orders)} DebtorOrderClient-ordrer.")
+    print(f"🗑️  {summary}")
+    for error in summary.errors:
+        print(f"❌ {error}")
+    _forget_posted_orders(summary.deleted_rows)
+    return summary
 
 
 # ------------------------------------------------------------------
@@ -91,34 +271,15 @@ def fetch_debtor_order_lines(
     reference_number: str,
 ) -> List[dict]:
     """
-    Henter alle DebtorOrderLineClientUser og filtrerer på ReferenceNumber.
+    Henter DebtorOrderLineClientUser med ReferenceNumber = reference_number (filtreret i Uniconta).
     """
-    url = f"{adapter.base_url}/Query/Get/DebtorOrderLineClientUser"
-
-    payload = [
-        {
-            "PropertyName": "OrderNumber",
-            "FilterValue": "",
-            "Skip": 0,
-            "Take": 0,
-            "OrderBy": "true",
-            "OrderByDescending": "false",
-        }
-    ]
-
-    resp = adapter.session.post(url, json=payload)
-    if not resp.ok:
-        raise RuntimeError(
-            f"Query/Get/DebtorOrderLineClientUser failed: {resp.status_code} {resp.text}"
-        )
-
-    data = resp.json() or []
+    data = _query_paged(adapter, "DebtorOrderLineClientUser", "ReferenceNumber", reference_number, order_by="RowId")
     filtered = [
         row for row in data
         if row.get("ReferenceNumber") == reference_number
     ]
 
-    print(f"🔍 DebtorOrderLineClientUser total: {len(data)}")
+    print(f"🔍 DebtorOrderLineClientUser hentet: {len(data)}")
     print(f"🔎 Matcher ReferenceNumber='{reference_number}': {len(filtered)}")
 
     return filtered
@@ -127,23 +288,35 @@ def fetch_debtor_order_lines(
 def delete_debtor_order_lines(
     adapter: UnicontaClient,
     lines: List[dict],
-):
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> DeleteSummary:
     """
-    Sletter DebtorOrderLineClientUser-linjer.
+    Sletter DebtorOrderLineClientUser-linjer i chunks.
     """
     if not lines:
         print("✅ Ingen linjer at slette.")
-        return
+        return DeleteSummary(table="DebtorOrderLineClientUser", requested=0)
 
-    url = f"{adapter.base_url}/Crud/DeleteList/DebtorOrderLineClientUser"
-    resp = adapter.session.delete(url, json=lines)
+    summary = _delete_chunked(adapter, "DebtorOrderLineClientUser", lines, key_field="RowId", progress=progress)
+
+    print(f"🗑️  {summary}")
+    for error in summary.errors:
+        print(f"❌ {error}")
+    _forget_posted_orders(summary.deleted_rows)
+    return summary
 
-    if not resp.ok:
-        raise RuntimeError(
-            f"DeleteList/DebtorOrderLineClientUser failed: {resp.status_code} {resp.text}"
-        )
 
-    print(f"🗑️  Slettede {len(lines)} ordrelinjer.")
+def _forget_posted_orders(rows: List[dict]):
+    """
+    Fjerner de slettede ordrer fra posting-journalen, så næste kørsel poster dem igen.
+    """
+    journal = PostingJournal()
+    try:
+        forgotten = journal.forget_orders({row.get("OrderNumber") for row in rows})
+    finally:
+        journal.close()
+    if forgotten:
+        print(f"📒 Fjernede {forgotten} poster fra posting-journalen.")
 
 
 # ------------------------------------------------------------------
@@ -1,10 +1,27 @@
-from RESTclients.Adapters.CloudFactoryToPython import generate_correct_product_line
+import itertools
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from RESTclients.Adapters.CloudFactoryToPython import compile_line_mapper, billing_date_cache_info
 from RESTclients.dataModels import CustomerInvoice_Error, CustomerInvoice, CustomerInvoiceCategory
-from adapters.excel import convert_excel_to_dict, get_id_keys
-from reconcilliation.utils import recon_data
+from adapters.excel import convert_excel_to_dict, iter_excel_rows, get_id_keys
+from adapters.parquet_cache import ParsedWorkbookCache
+from RESTclients.Uniconta.line_batcher import AdaptiveLineBatcher, line_signature
+from RESTclients.Uniconta.posting_journal import PostingJournal, DONE
+from RESTclients.Uniconta.uniconta import UNICONTA_POST_WORKERS
+from reconcilliation.utils import report_success_or_failure
+
+BILLING_PARSE_WORKERS = int(os.getenv("BILLING_PARSE_WORKERS", "0"))
+BILLING_PARSED_CACHE = os.getenv("BILLING_PARSED_CACHE", "True").lower() == "true"
+
+# customer id CloudFactory puts on billing rows that belong to no customer
+NO_CUSTOMER_ID = "00000000-0000-0000-0000-000000000000"
 
 
 def generate_customer_invoice(
+        context,
         previousCustomerid,
         customerid,
         vatID,
@@ -14,16 +31,13 @@ def generate_customer_invoice(
 ):
     if (
             previousCustomerid != customerid
-            and (customerid not in recon_data.invoice_customer_dict.keys())
-            and (customerid not in recon_data.failed_customer_list.keys())
+            and (customerid not in context.invoice_customer_dict.keys())
+            and (customerid not in context.failed_customer_list.keys())
     ):
-        potential_clients = list(
-            (
-                x
-                for x in uniconta_adapter.customerDataBase
-                if (x.id.lower() == customerid.lower())
-            )
-        )
+        potential_clients = uniconta_adapter.customer_index.find(customerid)
+        if not potential_clients and customerid != NO_CUSTOMER_ID and uniconta_adapter.refresh_customers():
+            # customer may have been created in CloudFactory after the snapshot was taken
+            potential_clients = uniconta_adapter.customer_index.find(customerid)
         match len(potential_clients):
             case 0:
                 customerInvoice = CustomerInvoice_Error(
@@ -34,7 +48,7 @@ def generate_customer_invoice(
                            + vatID,
                     categories={},
                 )
-                recon_data.failed_customer_list[customerid] = customerInvoice
+                context.failed_customer_list[customerid] = customerInvoice
             case 1:
                 customerInvoice = CustomerInvoice(
                     customer=potential_clients[0],
@@ -42,7 +56,7 @@ def generate_customer_invoice(
                     period_end=record.get("End Date", "ERROR"),
                     categories={},
                 )
-                recon_data.invoice_customer_dict[customerid] = customerInvoice
+                context.invoice_customer_dict[customerid] = customerInvoice
             case _:
                 customerInvoice = CustomerInvoice_Error(
                     customer=None,
@@ -52,12 +66,12 @@ def generate_customer_invoice(
                            + vatID,
                     categories={},
                 )
-                recon_data.failed_customer_list[customerid] = customerInvoice
+                context.failed_customer_list[customerid] = customerInvoice
     else:
-        if customerid in recon_data.failed_customer_list.keys():
-            customerInvoice = recon_data.failed_customer_list.get(customerid)
+        if customerid in context.failed_customer_list.keys():
+            customerInvoice = context.failed_customer_list.get(customerid)
         else:
-            customerInvoice = recon_data.invoice_customer_dict.get(customerid)
+            customerInvoice = context.invoice_customer_dict.get(customerid)
 
     if not customerInvoice:
         customerInvoice = CustomerInvoice_Error(
@@ -71,7 +85,7 @@ def generate_customer_invoice(
                    + "",
             categories={},
         )
-        recon_data.failed_customer_list[customerid] = customerInvoice
+        context.failed_customer_list[customerid] = customerInvoice
 
     return customerInvoice
 
@@ -87,81 +101,272 @@ def generate_invoice_category(invoice, catName):
     return category
 
 
-def generate_invoices_for_uniconta(cloudFac_client, uniconta_client, invoices, foundCatKeyDict):
+def parse_workbooks_in_processes(workbooks, workers):
+    """
+    Parse workbooks into BillingTables in a process pool, since openpyxl parsing is
+    pure python and otherwise keeps a single core busy. Tables pickle compactly
+    (one array per column). None entries (failed downloads) stay None.
+    """
+    tables = [None] * len(workbooks)
+    todo = [i for i, excel_bytes in enumerate(workbooks) if excel_bytes is not None]
+    if not todo:
+        return tables
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+        futures = {i: pool.submit(convert_excel_to_dict, workbooks[i], True) for i in todo}
+        for i, future in futures.items():
+            tables[i] = future.result()
+    print(f"Parsed {len(todo)} billing files in {time.perf_counter() - started:.2f}s using {min(workers, len(todo))} processes")
+
+    return tables
+
+
+def generate_invoices_for_uniconta(context, cloudFac_client, uniconta_client, invoices, foundCatKeyDict, download_workers=0, parse_workers=None, parsed_cache=None):
+    """
+    context (ReconciliationContext) collects the invoices, failures and totals of the run.
+    parse_workers > 1 parses all workbooks up front in a process pool;
+    otherwise each workbook is streamed row by row in this process.
+    parsed_cache=True reuses / stores parsed workbooks as Parquet keyed by workbook hash;
+    a workbook that isn't cached yet is still streamed, its table is only built to be stored.
+    """
     errors = 0
-    # preload excel data structures
-    for invoice in invoices:
-        for catKey in invoice.categories.keys():
-            foundCatKeyDict.add(catKey)
+    # the date memo lives for the whole process, so report this run's share of it
+    date_stats_start = billing_date_cache_info()
+    if invoices:
+        context.billing_period = (min(i.startDate for i in invoices), max(i.endDate for i in invoices))
+    if parse_workers is None:
+        parse_workers = BILLING_PARSE_WORKERS
+    if parsed_cache is None:
+        parsed_cache = BILLING_PARSED_CACHE
 
-            excel_bytes = cloudFac_client.fetch_billing_excel(
-                invoice.categories.get(catKey).excelLink
-            )
-            invoice_rows = convert_excel_to_dict(excel_bytes)
-            invoice.categories.get(catKey).excelLink = invoice_rows
-            id_key, vat_key, name_key, success = get_id_keys(invoice_rows)
-            if not success:
-                for record in invoice_rows:
-                    recon_data.add_failed_customer(catKey, record)
-                invoice.categories[catKey] = None
-                errors += 1
-                continue
-
-            invoice.categories.get(catKey).idKey = id_key
-            invoice.categories.get(catKey).vatKey = vat_key
-            invoice.categories.get(catKey).nameKey = name_key
+    table_cache = None
+    if parsed_cache:
+        if ParsedWorkbookCache.available():
+            table_cache = ParsedWorkbookCache()
+        else:
+            print("pyarrow is not installed - parsed workbook cache disabled")
+
+    # download all billing excels up front, in parallel
+    pending = [(invoice, catKey) for invoice in invoices for catKey in invoice.categories.keys()]
+    downloads = cloudFac_client.fetch_billing_excels(
+        [
+            (catKey, invoice.categories.get(catKey).excelLink, f"{invoice.startDate}_{invoice.endDate}")
+            for invoice, catKey in pending
+        ],
+        max_workers=download_workers,
+    )
+
+    tables = [None] * len(pending)
+    if parse_workers > 1:
+        if table_cache is not None:
+            tables = [table_cache.get(b) if b is not None else None for b in downloads]
+        missing = [b if t is None else None for b, t in zip(downloads, tables)]
+        for i, table in enumerate(parse_workbooks_in_processes(missing, parse_workers)):
+            if table is not None:
+                tables[i] = table
+                if table_cache is not None:
+                    table_cache.put(downloads[i], table)
+
+    # stream every workbook straight into customer invoices, one category at a time
+    for index, (invoice, catKey) in enumerate(pending):
+        excel_bytes = downloads[index]
+        table = tables[index]
+        downloads[index] = None  # drop the raw workbook once it has been handled
+        tables[index] = None
+        foundCatKeyDict.add(catKey)
+
+        if excel_bytes is None:
+            invoice.categories[catKey] = None
+            errors += 1
+            continue
+
+        if table is None and table_cache is not None:
+            table = table_cache.get(excel_bytes)
+
+        if table is not None:
+            invoice_rows = iter(table)
+        elif table_cache is not None:
+            # stream the rows as usual; the table is only built on the side to be cached
+            invoice_rows = iter_excel_rows(excel_bytes, on_table=lambda t, b=excel_bytes: table_cache.put(b, t))
+        else:
+            invoice_rows = iter_excel_rows(excel_bytes)
+        first_row = next(invoice_rows, None)
+        if first_row is None:
+            print(f"Billing file for {catKey} has no rows")
+            invoice.categories[catKey] = None
+            errors += 1
+            continue
+
+        invoice_rows = itertools.chain([first_row], invoice_rows)
+        id_key, vat_key, name_key, success = get_id_keys([first_row])
+        if not success:
+            for record in invoice_rows:
+                context.add_failed_customer(catKey, record)
+            invoice.categories[catKey] = None
+            errors += 1
+            continue
+
+        invoice.categories.get(catKey).idKey = id_key
+        invoice.categories.get(catKey).vatKey = vat_key
+        invoice.categories.get(catKey).nameKey = name_key
+
+        line_mapper = compile_line_mapper(catKey, first_row.headers)
+        add_category_rows(context, invoice, catKey, invoice_rows, id_key, vat_key, name_key, uniconta_client, line_mapper)
 
     # remove all categories that failed to get correct keys for important headers
     for invoice in invoices:
         invoice.categories = {k: v for k, v in invoice.categories.items() if v is not None}
 
-    for invoice in invoices:
-        for catKey in invoice.categories.keys():
-            invoice_rows = invoice.categories.get(catKey).excelLink
-            id_key = invoice.categories.get(catKey).idKey
-            vat_key = invoice.categories.get(catKey).vatKey
-            name_key = invoice.categories.get(catKey).nameKey
+    date_stats = billing_date_cache_info()
+    print(f"Date parsing: {date_stats.hits - date_stats_start.hits} memo hits, "
+          f"{date_stats.misses - date_stats_start.misses} parsed")
 
-            previous_customer_id = None
+    if table_cache is not None:
+        cache_stats = table_cache.stats()
+        print(f"Parsed workbook cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['bytes'] / 1024 / 1024:,.1f} MB on disk")
 
-            for row in invoice_rows:
-                raw_id = row.get(id_key)
+    return errors
 
-                customer_id = str(raw_id).replace("{", "").replace("}", "").lower()
 
+def add_category_rows(context, invoice, catKey, invoice_rows, id_key, vat_key, name_key, uniconta_client, line_mapper):
+    previous_customer_id = None
 
-                vatID = row.get(vat_key, "NULL") if vat_key else "NULL"
-                name = row.get(name_key, "NULL")
+    for row in invoice_rows:
+        raw_id = row.get(id_key)
+
+        customer_id = str(raw_id).replace("{", "").replace("}", "").lower()
 
-                # Build / reuse the CustomerInvoice / CustomerInvoice_Error
-                customer_invoice = generate_customer_invoice(
-                    previous_customer_id,
-                    customer_id,
-                    vatID,
-                    name,
-                    row,
-                    uniconta_client
-                )
 
-                previous_customer_id = customer_id
-                category = generate_invoice_category(customer_invoice, catKey)
-                line = generate_correct_product_line(catKey, row, invoice.startDate, invoice.endDate)
+        vatID = row.get(vat_key, "NULL") if vat_key else "NULL"
+        name = row.get(name_key, "NULL")
 
-                if customer_id == "00000000-0000-0000-0000-000000000000":
-                    recon_data.add_no_customer_id_row(line.Amount, catKey, row, name_key=name_key, vat_key=vat_key)
+        # Build / reuse the CustomerInvoice / CustomerInvoice_Error
+        customer_invoice = generate_customer_invoice(
+            context,
+            previous_customer_id,
+            customer_id,
+            vatID,
+            name,
+            row,
+            uniconta_client
+        )
 
-                # merge identical entries
-                # addtolist = True
-                # for index, catLine in enumerate(category.lines):
-                #    if catLine.can_merge(line):
-                #        category.lines[index] = catLine+line
-                #        addtolist = False
-                #        break
-                # if addtolist:
-                #    category.lines.append(line)
+        previous_customer_id = customer_id
+        category = generate_invoice_category(customer_invoice, catKey)
+        line = line_mapper(row, invoice.startDate, invoice.endDate)
 
-                category.lines.append(line)
+        if customer_id == NO_CUSTOMER_ID:
+            context.add_no_customer_id_row(line.Amount, catKey, row, name_key=name_key, vat_key=vat_key)
 
-                recon_data.add_to_total_amount(row)
+        # merge identical entries
+        # addtolist = True
+        # for index, catLine in enumerate(category.lines):
+        #    if catLine.can_merge(line):
+        #        category.lines[index] = catLine+line
+        #        addtolist = False
+        #        break
+        # if addtolist:
+        #    category.lines.append(line)
 
-    return errors
+        category.lines.append(line)
+        context.add_line(customer_invoice, catKey, line.Amount)
+
+        context.add_to_total_amount(row)
+
+
+def post_invoices_to_uniconta(context, uniconta_client, invoices, workers=0, use_journal=True):
+    """
+    Resolve debtor/order and build the lines of every customer invoice, then post all
+    lines through AdaptiveLineBatcher, workers chunks at a time, and report each invoice.
+    With use_journal, invoices the PostingJournal has as posted are skipped.
+    Returns errorSet: error text -> count, collected here in the calling thread.
+    """
+    invoices = list(invoices)
+    workers = max(1, workers or UNICONTA_POST_WORKERS)
+
+    uniconta_client.preload()
+
+    start = time.perf_counter()
+    built = [uniconta_client.build_order_lines(invoice, context) for invoice in invoices]
+    print(f"Built order lines for {len(invoices)} invoices in {time.perf_counter() - start:.1f}s")
+
+    errorSet = dict()
+    orders = []
+    for invoice, (lines, error) in zip(invoices, built):
+        if lines is None:
+            errorSet[error] = errorSet.get(error, 0) + 1
+        else:
+            orders.append((invoice, lines))
+
+    period = context.billing_period
+    if use_journal and period is None:
+        print("No billing period on the context - posting without the journal")
+    journal = PostingJournal() if use_journal and period is not None else None
+    try:
+        if journal is not None:
+            orders = _skip_journaled_orders(context, uniconta_client, journal, orders, errorSet)
+            journal.begin(
+                (journal.key(invoice, period), lines[0]["OrderNumber"] if lines else None, journal.lines_hash(lines), len(lines))
+                for invoice, lines in orders
+            )
+
+        on_done = None
+        if journal is not None:
+            # marked right away, so a crash later in the run doesn't leave it pending
+            on_done = lambda i: journal.mark_done([journal.key(orders[i][0], period)])
+
+        results = AdaptiveLineBatcher(uniconta_client, workers=workers).post(orders, on_done=on_done)
+        for (invoice, _), posted in zip(orders, results):
+            report_success_or_failure(context, invoice, posted)
+            if not posted:
+                errorSet["Could not post order lines"] = errorSet.get("Could not post order lines", 0) + 1
+    finally:
+        if journal is not None:
+            journal.close()
+
+    return errorSet
+
+
+def _skip_journaled_orders(context, uniconta_client, journal, orders, errorSet):
+    """
+    Drop orders the journal already has. Done with the same lines -> skipped as posted.
+    Pending or changed -> look for this invoice's lines on the order in Uniconta (other
+    invoices may share the open order): none means post again, all of them means it
+    finished after all, anything else needs a manual look.
+    """
+    period = context.billing_period
+    to_post = []
+    skipped = 0
+    for invoice, lines in orders:
+        key = journal.key(invoice, period)
+        entry = journal.get(key)
+        if entry is None:
+            to_post.append((invoice, lines))
+            continue
+
+        lines_hash = journal.lines_hash(lines)
+        if entry["status"] == DONE and entry["lines_hash"] == lines_hash:
+            report_success_or_failure(context, invoice, True)
+            skipped += 1
+            continue
+
+        posted_lines = uniconta_client.get_order_lines_by_order_number(entry["order_number"]) if entry["order_number"] else []
+        on_order = Counter(line_signature(row) for row in posted_lines)
+        found = sum(min(on_order[sig], n) for sig, n in Counter(line_signature(line) for line in lines).items())
+        if found == 0:
+            to_post.append((invoice, lines))
+        elif entry["lines_hash"] == lines_hash and found == len(lines):
+            journal.mark_done([key])
+            report_success_or_failure(context, invoice, True)
+            skipped += 1
+        else:
+            print(f"Order {entry['order_number']} for customer {invoice.customer.id} already has "
+                  f"{found} of its {len(lines)} lines, not posting again")
+            report_success_or_failure(context, invoice, False)
+            error = "Order already has posted lines, check manually"
+            errorSet[error] = errorSet.get(error, 0) + 1
+
+    if skipped:
+        print(f"Skipped {skipped} invoices already posted according to the posting journal")
+    return to_post
@@ -1,25 +1,307 @@
 import io
 
+import numpy as np
 from openpyxl import load_workbook
 
-def convert_excel_to_dict(excel_bytes):
-    wb = load_workbook(io.BytesIO(excel_bytes))
-    ws = wb.active
+
+def _billing_sheet(wb):
     if wb.active.title == "Usage" or wb.active.title == "Acronis Total":
-       ws = wb.worksheets[1]
-    else:
-       ws = wb.active
-
-    # header row
-    header_row = next(ws.iter_rows(values_only=True))
-    headers = [cell for cell in header_row]
-
-    row_dicts = []
-    for row in list(ws.iter_rows(min_row=2, values_only=True)):
-        row_dicts.append(
-            dict(zip(headers, row))
-        )
-    return row_dicts
+        return wb.worksheets[1]
+    return wb.active
+
+
+def _iter_sheet(excel_bytes):
+    """Yield the header tuple of the billing sheet followed by every data row as a tuple."""
+    wb = load_workbook(io.BytesIO(excel_bytes), read_only=True)
+    try:
+        ws = _billing_sheet(wb)
+        rows = ws.iter_rows(values_only=True)
+
+        # header row
+        headers = tuple(next(rows, ()))
+        width = len(headers)
+        yield headers
+
+        for row in rows:
+            if len(row) < width:
+                # read-only rows stop at the last cell the sheet declares
+                row = row + (None,) * (width - len(row))
+            yield row
+    finally:
+        wb.close()
+
+
+def iter_excel_rows(excel_bytes, on_table=None):
+    """
+    Stream the billing sheet of a workbook one SheetRow at a time.
+    The workbook is opened in read-only mode, so rows are parsed lazily and
+    never all held in memory at once.
+    on_table(BillingTable) is called once the last row has been read, with the
+    sheet as read (before any change to the rows), fx to store it in a cache.
+    """
+    rows = _iter_sheet(excel_bytes)
+    header = SheetHeader(next(rows))
+    builder = _ColumnBuilder(header.headers) if on_table is not None else None
+    for row in rows:
+        if builder is not None:
+            builder.add(row)
+        yield SheetRow(header, row)
+    if builder is not None:
+        on_table(builder.build())
+
+
+def convert_excel_to_dict(excel_bytes, columnar=False):
+    """
+    Parse the billing sheet of a workbook.
+    columnar=False gives a list of row dicts, columnar=True a BillingTable.
+    """
+    rows = _iter_sheet(excel_bytes)
+    headers = next(rows)
+    if columnar:
+        return BillingTable.from_rows(headers, rows)
+    return [dict(zip(headers, row)) for row in rows]
+
+
+def _header_positions(headers):
+    # later duplicate headers win, same as dict(zip(headers, row))
+    return {h: i for i, h in enumerate(headers)}
+
+
+def _to_array(values):
+    """
+    Pack one column into a numpy array without changing the python types the
+    rows hand back. Whole numbers in money columns come out of openpyxl as int,
+    so a mixed int/float column is stored as float64 plus a mask of the ints.
+    Returns (array, int_mask or None).
+    """
+    kinds = {type(v) for v in values}
+    if kinds == {float}:
+        return np.array(values, dtype=np.float64), None
+    if kinds == {int}:
+        try:
+            return np.array(values, dtype=np.int64), None
+        except OverflowError:
+            pass
+    if kinds == {int, float} and all(abs(v) <= 2 ** 53 for v in values if type(v) is int):
+        return np.array(values, dtype=np.float64), np.array([type(v) is int for v in values], dtype=bool)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column, None
+
+
+class _ColumnBuilder:
+    """Collects value tuples column by column and packs them into a BillingTable."""
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.positions = _header_positions(headers)
+        self.values = {h: [] for h in self.positions}
+        self.length = 0
+
+    def add(self, row):
+        for h, i in self.positions.items():
+            self.values[h].append(row[i])
+        self.length += 1
+
+    def build(self):
+        columns = {}
+        int_masks = {}
+        for h, column_values in self.values.items():
+            columns[h], mask = _to_array(column_values)
+            if mask is not None:
+                int_masks[h] = mask
+        return BillingTable(self.headers, columns, self.length, int_masks)
+
+
+class BillingTable:
+    """
+    Columnar billing sheet: one shared header and one array per column.
+    Iterating gives BillingRow views, so code written against row dicts
+    (record.get(...), "key" in record) works unchanged.
+    """
+
+    def __init__(self, headers, columns, length, int_masks=None):
+        self.headers = list(headers)
+        self.positions = _header_positions(self.headers)
+        self.columns = columns
+        self.int_masks = int_masks or {}
+        self._length = length
+
+    @classmethod
+    def from_rows(cls, headers, rows):
+        builder = _ColumnBuilder(headers)
+        for row in rows:
+            builder.add(row)
+        return builder.build()
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield BillingRow(self, index)
+
+    def __getitem__(self, index):
+        if not -self._length <= index < self._length:
+            raise IndexError(index)
+        return BillingRow(self, index % self._length)
+
+    def column(self, key):
+        return self.columns[key]
+
+    def value(self, index, key, default=None):
+        column = self.columns.get(key)
+        if column is None:
+            return default
+        value = column[index]
+        if isinstance(value, np.generic):
+            value = value.item()
+            mask = self.int_masks.get(key)
+            if mask is not None and mask[index]:
+                value = int(value)
+        return value
+
+    def set_value(self, index, key, value):
+        column = self.columns[key]
+        if column.dtype != object and type(value) is not type(self.value(index, key)):
+            column = self._as_object(key)
+        column[index] = value
+
+    def _as_object(self, key):
+        column = np.empty(self._length, dtype=object)
+        column[:] = [self.value(i, key) for i in range(self._length)]
+        self.columns[key] = column
+        self.int_masks.pop(key, None)
+        return column
+
+
+class _RowView:
+    """
+    Dict-like access to one row whose header is shared with the rest of the sheet.
+    Subclasses provide positions, headers, at(position) (the cell in that header
+    position), _value(key, default) and _store(key, value).
+    """
+
+    __slots__ = ("_extra",)
+
+    def get(self, key, default=None):
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        return self._value(key, default)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        if key in self.positions:
+            self._store(key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.positions or bool(self._extra and key in self._extra)
+
+    def keys(self):
+        keys = list(self.positions)
+        if self._extra:
+            keys += [k for k in self._extra if k not in self.positions]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self.get(k)) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, _RowView):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        # same text as the row dict, so csv/print output does not depend on the row type
+        return repr(self.to_dict())
+
+
+class SheetHeader:
+    """Header row of a streamed sheet, shared by all of its SheetRows."""
+
+    __slots__ = ("headers", "positions")
+
+    def __init__(self, headers):
+        self.headers = tuple(headers)
+        self.positions = _header_positions(self.headers)
+
+
+class SheetRow(_RowView):
+    """One streamed row: the raw value tuple plus the shared SheetHeader."""
+
+    __slots__ = ("header", "values")
+
+    def __init__(self, header, values):
+        self.header = header
+        self.values = values
+        self._extra = None
+
+    @property
+    def headers(self):
+        return self.header.headers
+
+    @property
+    def positions(self):
+        return self.header.positions
+
+    def at(self, position):
+        return self.values[position]
+
+    def _value(self, key, default):
+        position = self.header.positions.get(key)
+        if position is None:
+            return default
+        return self.values[position]
+
+    def _store(self, key, value):
+        if isinstance(self.values, tuple):
+            self.values = list(self.values)
+        self.values[self.header.positions[key]] = value
+
+
+class BillingRow(_RowView):
+    """Read/write view of one row in a BillingTable."""
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self._extra = None
+
+    @property
+    def headers(self):
+        return self.table.headers
+
+    @property
+    def positions(self):
+        return self.table.positions
+
+    def at(self, position):
+        return self.table.value(self.index, self.table.headers[position])
+
+    def _value(self, key, default):
+        return self.table.value(self.index, key, default)
+
+    def _store(self, key, value):
+        self.table.set_value(self.index, key, value)
 
 def convert_row_to_dict(catKey, row):
     ret = {
@@ -0,0 +1,196 @@
+"""
+Disk cache of parsed billing workbooks.
+
+Parsing xlsx through openpyxl costs seconds per file, so the parsed BillingTable
+is stored as Parquet keyed by the sha256 of the workbook bytes. A re-run on the
+same workbook reads the columns back with pyarrow instead of re-parsing.
+Files are evicted least recently used first once the size budget is exceeded.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from adapters.excel import BillingTable, _to_array
+from reconcilliation.utils import CACHE_DIR
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # the cache is an optimisation - run without it
+    pa = None
+    pq = None
+
+PARSED_CACHE_DIR = CACHE_DIR / "parsed"
+PARSED_CACHE_MAX_MB = int(os.getenv("BILLING_PARSED_CACHE_MAX_MB", "256"))
+
+# python types a single Parquet column can hand back unchanged
+_STORABLE_TYPES = (str, int, float, bool, datetime.datetime)
+
+
+def _encode_header(value):
+    """Headers go into JSON metadata; date cells used as headers are tagged so they come back as dates."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    raise TypeError(f"header {value!r} can't be stored in the parsed cache")
+
+
+def _decode_header(value):
+    if isinstance(value, dict):
+        if "datetime" in value:
+            return datetime.datetime.fromisoformat(value["datetime"])
+        return datetime.date.fromisoformat(value["date"])
+    return value
+
+
+class ParsedWorkbookCache:
+
+    def __init__(self, cache_dir: Path = PARSED_CACHE_DIR, max_bytes: int = PARSED_CACHE_MAX_MB * 1024 * 1024) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def available() -> bool:
+        return pa is not None
+
+    @staticmethod
+    def key(excel_bytes: bytes) -> str:
+        return hashlib.sha256(excel_bytes).hexdigest()
+
+    def get(self, excel_bytes: bytes) -> Optional[BillingTable]:
+        path = self._path(self.key(excel_bytes))
+        if not path.exists():
+            self.misses += 1
+            return None
+        try:
+            table = self._from_arrow(pq.read_table(path))
+        except Exception as e:
+            print(f"Parsed cache entry {path.name} is unreadable, parsing again: {e}")
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+
+        os.utime(path)  # mark as recently used
+        self.hits += 1
+        return table
+
+    def put(self, excel_bytes: bytes, table: BillingTable) -> bool:
+        try:
+            arrow_table = self._to_arrow(table)
+        except TypeError as e:
+            print(f"Not caching parsed workbook: {e}")
+            return False
+        if arrow_table is None:
+            return False
+
+        path = self._path(self.key(excel_bytes))
+        # own temp file per writer, parallel puts of the same workbook must not share one
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+            tmp = Path(f.name)
+        try:
+            pq.write_table(arrow_table, tmp)
+            tmp.replace(path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        self._evict()
+        return True
+
+    def stats(self) -> dict:
+        files = list(self.cache_dir.glob("*.parquet"))
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(files),
+            "bytes": sum(f.stat().st_size for f in files),
+        }
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def _evict(self) -> None:
+        files = sorted(self.cache_dir.glob("*.parquet"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        while total > self.max_bytes and files:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+
+    @staticmethod
+    def _to_arrow(table: BillingTable):
+        """
+        Columns are stored positionally (c0, c1, ...) with the real headers in the
+        schema metadata, since headers may be None or repeated. Numeric columns with
+        blanks (int, float and None mixed) are stored as float64 with nulls plus a
+        mask of the ints (m0, m1, ...). Returns None when a column mixes value types
+        Parquet cannot give back as-is; raises TypeError for headers it can't store.
+        """
+        keys = list(table.columns)
+        arrays = {}
+        for i, key in enumerate(keys):
+            column = table.columns[key]
+            if column.dtype != object:
+                arrays[f"c{i}"] = pa.array(column)
+                mask = table.int_masks.get(key)
+                if mask is not None:
+                    arrays[f"m{i}"] = pa.array(mask)
+                continue
+
+            values = list(column)
+            kinds = {type(v) for v in values if v is not None}
+            if kinds and kinds <= {int, float} and all(abs(v) <= 2 ** 53 for v in values if type(v) is int):
+                arrays[f"c{i}"] = pa.array([None if v is None else float(v) for v in values], type=pa.float64())
+                arrays[f"m{i}"] = pa.array([type(v) is int for v in values])
+                continue
+            if len(kinds) > 1 or not kinds <= set(_STORABLE_TYPES):
+                return None
+            kind = next(iter(kinds), None)
+            try:
+                arrays[f"c{i}"] = pa.array(values, type=pa.null() if kind is None else None)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                return None
+
+        metadata = {
+            "headers": json.dumps([_encode_header(h) for h in table.headers]),
+            "keys": json.dumps([_encode_header(k) for k in keys]),
+            "length": str(len(table)),
+        }
+        return pa.table(arrays).replace_schema_metadata(metadata)
+
+    @staticmethod
+    def _from_arrow(arrow_table) -> BillingTable:
+        metadata = arrow_table.schema.metadata
+        headers = [_decode_header(h) for h in json.loads(metadata[b"headers"])]
+        keys = [_decode_header(k) for k in json.loads(metadata[b"keys"])]
+        length = int(metadata[b"length"])
+
+        columns = {}
+        int_masks = {}
+        for i, key in enumerate(keys):
+            column = arrow_table.column(f"c{i}")
+            if (pa.types.is_floating(column.type) or pa.types.is_integer(column.type)) and column.null_count == 0:
+                # copy, so rows can still be written to (arrow buffers are read-only)
+                columns[key] = np.array(column.to_numpy())
+                if f"m{i}" in arrow_table.column_names:
+                    int_masks[key] = np.array(arrow_table.column(f"m{i}").to_numpy())
+                continue
+            values = column.to_pylist()
+            if f"m{i}" in arrow_table.column_names:
+                # numeric column with blanks: give the ints back as int
+                mask = arrow_table.column(f"m{i}").to_pylist()
+                values = [int(v) if v is not None and is_int else v for v, is_int in zip(values, mask)]
+            columns[key], _ = _to_array(values)
+
+        return BillingTable(headers, columns, length, int_masks)
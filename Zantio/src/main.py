@@ -4,76 +4,111 @@ global DRY_RUN
 from dotenv import load_dotenv
 load_dotenv()
 
-from reconcilliation.utils import setupStreamletPage, recon_data
+from reconcilliation.utils import setupStreamletPage, ReconciliationContext, BUCKET_SUCCESS, BUCKET_FAILED, ore_to_dkk, run_output
+from reconcilliation.name_matcher import DebtorNameMatcher
 from RESTclients.Uniconta import uniconta as uc
 from RESTclients.CloudFactory import cloudfactory as cf
-from RESTclients.utils import generate_invoices_for_uniconta
+from RESTclients.CloudFactory.customer_store import CustomerSnapshotStore, sync_customers
+from RESTclients.utils import generate_invoices_for_uniconta, post_invoices_to_uniconta, BILLING_PARSE_WORKERS
 
 
 
 def main(*args, **kwargs):
-    DRY_RUN = kwargs.get("DRY_RUN", "True").lower() == "true"
+    # pass your own context (with its own output_dir and stdout/stderr) to run several reconciliations side by side
+    context = kwargs.get("context") or ReconciliationContext()
+    with run_output(context.stdout, context.stderr):
+        return run_reconciliation(context, **kwargs)
+
 
-    recon_data.reset()
+def run_reconciliation(context, **kwargs):
+    DRY_RUN = kwargs.get("DRY_RUN", "True").lower() == "true"
+    REFRESH_CACHE = kwargs.get("REFRESH_CACHE", "False").lower() == "true"
+    CUSTOMER_SYNC = kwargs.get("CUSTOMER_SYNC", "delta" if REFRESH_CACHE else "auto").lower()
+    # a refresh reloads all debtors, so ones deleted in Uniconta drop out of the index
+    DEBTOR_SYNC = kwargs.get("DEBTOR_SYNC", "full" if REFRESH_CACHE else uc.UNICONTA_DEBTOR_SYNC).lower()
 
-    cloudFac_client = cf.CloudFactoryClient()
+    cloudFac_client = cf.CloudFactoryClient(refresh_cache=REFRESH_CACHE)
     uniconta_client = uc.UnicontaClient()
+    uniconta_client.debtor_sync_mode = DEBTOR_SYNC
+
+    try:
+        print(format_str_with_color("Fetching customers from CloudFactory...", "blue"))
+
+        customer_store = CustomerSnapshotStore()
+        try:
+            uniconta_client.customerDataBase = customer_store.sync(cloudFac_client, mode=CUSTOMER_SYNC)
+            used_snapshot = customer_store.last_sync_mode == "snapshot"
+        finally:
+            customer_store.close()
+
+        if CUSTOMER_SYNC == "auto" and used_snapshot:
+            # a billing row for a customer created since the snapshot triggers one delta sync
+            uniconta_client.customer_resync = lambda: sync_customers(cloudFac_client, mode="delta")
+
+        print(format_str_with_color(f"Found {len(uniconta_client.customerDataBase)} Cloudfactory Customers", "orange"))
+        print(" ")
 
-    print(format_str_with_color("Fetching customers from CloudFactory...", "blue"))
+        print(format_str_with_color(f"Fetching latest invoice from CloudFactory...", "blue"))
 
-    uniconta_client.customerDataBase = cloudFac_client.list_customers()
+        invoices, success = cloudFac_client.fetch_latest_invoices()
 
-    print(format_str_with_color(f"Found {len(uniconta_client.customerDataBase)} Cloudfactory Customers", "orange"))
-    print(" ")
+        if success: print(format_str_with_color(f"Found {len(invoices)} invoices", "orange"))
+        else: print(format_str_with_color("No invoices found","red"))
+        print(" ")
+        foundCatKeyDict = set()
 
-    print(format_str_with_color(f"Fetching latest invoice from CloudFactory...", "blue"))
+        print(format_str_with_color("Generating invoices...", "blue"))
 
-    invoices, success = cloudFac_client.fetch_latest_invoices()
+        errors = generate_invoices_for_uniconta(
+            context, cloudFac_client, uniconta_client, invoices, foundCatKeyDict,
+            parse_workers=int(kwargs.get("PARSE_WORKERS", BILLING_PARSE_WORKERS)),
+        )
 
-    if success: print(format_str_with_color(f"Found {len(invoices)} invoices", "orange"))
-    else: print(format_str_with_color("No invoices found","red"))
-    print(" ")
-    foundCatKeyDict = set()
+        if errors > 0: print(format_str_with_color(f"Generated invoices with {errors} errors", "red"))
+        else: print(format_str_with_color(f"Generated invoices with {errors} errors", "blue"))
+        print(" ")
 
-    print(format_str_with_color("Generating invoices...", "blue"))
+        print(format_str_with_color("Creating missing uniconta orders...", "blue"))
+        uniconta_client.prepare_orders(context.invoice_customer_dict.values(), context)
+        print(" ")
 
-    errors = generate_invoices_for_uniconta(cloudFac_client, uniconta_client, invoices, foundCatKeyDict)
+        print(format_str_with_color("Creating uniconta orders with lines...", "blue"))
+        errorSet = post_invoices_to_uniconta(
+            context, uniconta_client, context.invoice_customer_dict.values(),
+            workers=int(kwargs.get("POST_WORKERS", uc.UNICONTA_POST_WORKERS)),
+            use_journal=kwargs.get("USE_JOURNAL", "True").lower() == "true",
+        )
 
-    if errors > 0: print(format_str_with_color(f"Generated invoices with {errors} errors", "red"))
-    else: print(format_str_with_color(f"Generated invoices with {errors} errors", "blue"))
-    print(" ")
+        if len(errorSet.keys()) > 0: [print(format_str_with_color(f"Found {errorSet[x]} errors for error:Type {x}", "red"))for x in errorSet.keys()]
+        else: print(format_str_with_color("No errors found", "green"))
+        print(" ")
 
-    print(format_str_with_color("Creating uniconta orders with lines...", "blue"))
-    errorSet = dict()
+        total = 0
+        failedtotal = 0
 
-    for customerInvoice in recon_data.invoice_customer_dict.values():
-        error = uniconta_client.create_uniconta_order_with_lines(customerInvoice)
-        if error:
-            val = errorSet.get(error, 0)
-            errorSet[error] = val + 1
+        # category totals are kept in øre, see ReconciliationContext
+        for key, ore in context.category_ore[BUCKET_SUCCESS].items():
+            print(f"Category: {key:<30} total: {ore_to_dkk(ore):>15,.2f}")
+            total += ore
+        print("-" * 60)
+        print(f"Category: {'TOTAL':<30} total: {ore_to_dkk(total):>15,.2f}")
+        print(" ")
+        for key, ore in context.category_ore[BUCKET_FAILED].items():
+            print(f"Category: {key:<30} total: {ore_to_dkk(ore):>15,.2f}")
+            failedtotal += ore
 
-    if len(errorSet.keys()) > 0: [print(format_str_with_color(f"Found {errorSet[x]} errors for error:Type {x}", "red"))for x in errorSet.keys()]
-    else: print(format_str_with_color("No errors found", "green"))
-    print(" ")
+        print("-" * 60)
+        print(f"Category: {'TOTAL FAILED':<30} total: {ore_to_dkk(failedtotal):>15,.2f}")
 
-    total = 0
-    failedtotal = 0
+        context.debtor_index_stats = uniconta_client.debtor_index_stats
 
-    for key, item in recon_data.billed_invoice_kay.items():
-        print(f"Category: {key:<30} total: {item:>15,.2f}")
-        total += item
-    print("-" * 60)
-    print(f"Category: {'TOTAL':<30} total: {total:>15,.2f}")
-    print(" ")
-    for key, item in recon_data.billed_invoice_kay_fail.items():
-        print(f"Category: {key:<30} total: {item:>15,.2f}")
-        failedtotal += item
+        name_matcher = DebtorNameMatcher(uniconta_client.debtors()) if context.failedList else None
 
-    print("-" * 60)
-    print(f"Category: {'TOTAL FAILED':<30} total: {failedtotal:>15,.2f}")
+        print(format_str_with_color("Setup StreamletPage...", "blue"))
+        setupStreamletPage(context, foundCatKeyDict, name_matcher)
+    finally:
+        uniconta_client.close()
 
-    print(format_str_with_color("Setup StreamletPage...", "blue"))
-    setupStreamletPage(foundCatKeyDict)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
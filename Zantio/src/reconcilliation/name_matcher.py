@@ -0,0 +1,105 @@
+"""
+Forslag til Uniconta-debitorer for kunder uden VAT-match.
+
+Debitornavne normaliseres (små bogstaver, uden tegnsætning og selskabsform) og
+lægges i et trigram-indeks pr. landekode. En kunde scores kun mod debitorer der
+deler trigrammer med kundens navn i samme land (plus debitorer uden kendt land),
+så der ikke sammenlignes alle-mod-alle. Score er Dice-koefficienten på trigrammer.
+"""
+
+import heapq
+import os
+import re
+from collections import defaultdict
+from typing import List, Optional
+
+NAME_SUGGESTIONS_TOP_K = int(os.getenv("NAME_SUGGESTIONS_TOP_K", "3"))
+NAME_SUGGESTIONS_MIN_SCORE = float(os.getenv("NAME_SUGGESTIONS_MIN_SCORE", "0.3"))
+
+# selskabsformer der ikke siger noget om hvem kunden er
+_LEGAL_FORMS = {
+    "aps", "as", "a", "s", "ab", "asa", "oy", "oyj", "gmbh", "ag", "ltd", "limited",
+    "inc", "llc", "bv", "nv", "sa", "sarl", "ivs", "is", "ks", "pmv", "smba", "amba",
+}
+
+# Uniconta-landenavne -> ISO-kode, til blocking mod CloudFactory countryCode
+_COUNTRY_CODES = {
+    "denmark": "DK", "danmark": "DK", "sweden": "SE", "sverige": "SE", "norway": "NO", "norge": "NO",
+    "finland": "FI", "germany": "DE", "tyskland": "DE", "unitedkingdom": "GB", "england": "GB",
+    "netherlands": "NL", "holland": "NL", "iceland": "IS", "island": "IS", "faroeislands": "FO",
+    "færøerne": "FO", "greenland": "GL", "grønland": "GL", "poland": "PL", "polen": "PL",
+    "france": "FR", "frankrig": "FR", "spain": "ES", "spanien": "ES", "unitedstates": "US", "usa": "US",
+}
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize_name(name) -> str:
+    words = _NON_WORD.sub(" ", str(name or "").lower().replace("a/s", "as").replace("i/s", "is")).split()
+    return " ".join(w for w in words if w not in _LEGAL_FORMS)
+
+
+def _trigrams(name: str) -> set:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _country_code(value) -> str:
+    s = str(value or "").strip()
+    if len(s) == 2 and s.isalpha():
+        return s.upper()
+    return _COUNTRY_CODES.get(s.lower().replace(" ", ""), "")
+
+
+class DebtorNameMatcher:
+
+    def __init__(self, debtors: List[dict], top_k: int = 0, min_score: float = 0.0) -> None:
+        self.top_k = top_k or NAME_SUGGESTIONS_TOP_K
+        self.min_score = min_score or NAME_SUGGESTIONS_MIN_SCORE
+
+        self._debtors = []
+        self._gram_counts = []
+        # country code ("" = unknown) -> trigram -> debtor positions
+        self._blocks = defaultdict(lambda: defaultdict(list))
+
+        for row in debtors:
+            name = normalize_name(row.get("Name") or row.get("Account Name"))
+            if not name:
+                continue
+            grams = _trigrams(name)
+            pos = len(self._debtors)
+            self._debtors.append(row)
+            self._gram_counts.append(len(grams))
+            block = self._blocks[_country_code(row.get("Country"))]
+            for gram in grams:
+                block[gram].append(pos)
+
+    def suggest(self, name, country_code: Optional[str] = None) -> List[tuple]:
+        """Top-k (score, debtor row) for a customer name, best first."""
+        query = normalize_name(name)
+        if not query:
+            return []
+        grams = _trigrams(query)
+
+        cc = _country_code(country_code)
+        blocks = [self._blocks[cc], self._blocks[""]] if cc else list(self._blocks.values())
+
+        shared = defaultdict(int)
+        for block in blocks:
+            for gram in grams:
+                for pos in block.get(gram, ()):
+                    shared[pos] += 1
+
+        scored = (
+            (2 * common / (len(grams) + self._gram_counts[pos]), pos)
+            for pos, common in shared.items()
+        )
+        best = heapq.nlargest(self.top_k, (item for item in scored if item[0] >= self.min_score))
+        return [(round(score, 2), self._debtors[pos]) for score, pos in best]
+
+    def suggest_text(self, name, country_code: Optional[str] = None) -> str:
+        """Forslagene som én CSV-celle: 'Account Navn (score); ...'."""
+        return "; ".join(
+            f"{row.get('Account')} {row.get('Name') or row.get('Account Name') or ''} ({score:.2f})".replace("  ", " ")
+            for score, row in self.suggest(name, country_code)
+        )
@@ -1,6 +1,10 @@
 
+import contextvars
 import csv
 import json
+import sys
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 from RESTclients.dataModels import CustomerInvoice, CustomerInvoice_Error
@@ -9,42 +13,173 @@ from adapters.excel import convert_row_to_dict
 BASE_DIR = Path(__file__).resolve().parent
 OUTPUT_DIR = BASE_DIR / "output"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = OUTPUT_DIR / "cache"
 
-class recon_data:
-    total_failed_cf = None
-    total_amount_all = 0.0
-    total_amount_success = 0.0
-    total_amount_failed = 0.0
-    total_amount_no_customer_id = 0.0
-    success_rows = []
-    no_customer_id_rows = []
-    failedList = []
-    invoice_customer_dict: dict[str, CustomerInvoice] = {}
-    failed_customer_list: dict[str, CustomerInvoice_Error] = {}
-    billed_invoice_kay: dict[str, float] = {}
-    billed_invoice_kay_fail: dict[str, float] = {}
-
-    @classmethod
-    def add_failed_customer(cls, catKey, record):
-        try:
-            amount_val = float(record.get("Amount", 0) or 0)
-        except (TypeError, ValueError):
-            amount_val = 0.0
+# control total buckets, summed in øre on ReconciliationContext.bucket_ore
+BUCKET_ALL = "all"
+BUCKET_SUCCESS = "success"
+BUCKET_FAILED = "failed"
+BUCKET_FAILED_CF = "failed_cf"
+BUCKET_NO_CUSTOMER_ID = "no_customer_id"
+BUCKETS = (BUCKET_ALL, BUCKET_SUCCESS, BUCKET_FAILED, BUCKET_FAILED_CF, BUCKET_NO_CUSTOMER_ID)
 
-        cls.total_amount_no_customer_id += amount_val
 
-        cls.no_customer_id_rows.append(convert_row_to_dict(catKey, record))
+# print output of the current run, see run_output
+_run_stdout = contextvars.ContextVar("run_stdout", default=None)
+_run_stderr = contextvars.ContextVar("run_stderr", default=None)
+_run_stream_lock = threading.Lock()
 
-    @classmethod
-    def add_to_total_amount(cls, record):
-        try:
-            amount_val = float(record.get("Amount", 0) or 0)
-        except (TypeError, ValueError):
-            amount_val = 0.0
-        recon_data.total_amount_all += amount_val
 
-    @classmethod
-    def add_no_customer_id_row(cls, amount_val, cat_key, record, name_key="", vat_key=""):
+class _RunStream:
+    """Stand-in for sys.stdout/sys.stderr: writes go to the current run's stream, else to the process' own."""
+
+    def __init__(self, fallback, stream_var) -> None:
+        self._fallback = fallback
+        self._stream_var = stream_var
+
+    def _target(self):
+        return self._stream_var.get() or self._fallback
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._fallback, name)
+
+
+@contextmanager
+def run_output(stdout=None, stderr=None):
+    """
+    Send print output of this thread to stdout/stderr (None keeps the process stream).
+    Unlike contextlib.redirect_stdout other threads are not affected, so runs in
+    parallel threads keep their own output; thread pools of a run pass it on with
+    in_run_context.
+    """
+    with _run_stream_lock:
+        if not isinstance(sys.stdout, _RunStream):
+            sys.stdout = _RunStream(sys.stdout, _run_stdout)
+        if not isinstance(sys.stderr, _RunStream):
+            sys.stderr = _RunStream(sys.stderr, _run_stderr)
+
+    stdout_token = _run_stdout.set(stdout)
+    stderr_token = _run_stderr.set(stderr)
+    try:
+        yield
+    finally:
+        _run_stdout.reset(stdout_token)
+        _run_stderr.reset(stderr_token)
+
+
+def in_run_context(fn):
+    """fn bound to the calling thread's run output, for work handed to a thread pool."""
+    ctx = contextvars.copy_context()
+    # a context can only be entered by one thread at a time, so each call runs in its own copy
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+
+def to_ore(value) -> int:
+    """DKK-beløb -> hele øre. Tomme/ugyldige beløb tæller som 0."""
+    try:
+        return int(round(float(value or 0) * 100))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def ore_to_dkk(ore: int) -> float:
+    return ore / 100
+
+
+class ReconciliationContext:
+    """
+    All accumulators of one reconciliation run. Create one per run and pass it
+    along; runs with their own context (and output_dir) can go in parallel threads.
+
+    Amounts are summed once, in integer øre, while the lines are produced:
+    per customer invoice and category (invoice_ore), per bucket (bucket_ore) and
+    per category for posted / failed invoices (category_ore). Reports and CSV
+    exports read these totals and convert to DKK only for output.
+    """
+
+    def __init__(self, output_dir: Path = OUTPUT_DIR, stdout=None, stderr=None) -> None:
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # where the run's print output goes (None = the process' own), see run_output
+        self.stdout = stdout
+        self.stderr = stderr
+        # posting runs in worker threads, totals are updated under this lock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.total_failed_cf = None
+        self.success_rows = []
+        self.no_customer_id_rows = []
+        self.failedList = []
+        self.invoice_customer_dict: dict[str, CustomerInvoice] = {}
+        self.failed_customer_list: dict[str, CustomerInvoice_Error] = {}
+        self.debtor_index_stats: dict = {}
+        # matched Uniconta debtor per customer, see UnicontaClient._match_debtor
+        self.debtor_matches: dict = {}
+        # (startDate, endDate) of the CloudFactory invoices of the run, set by generate_invoices_for_uniconta
+        self.billing_period = None
+
+        self.bucket_ore: dict[str, int] = {bucket: 0 for bucket in BUCKETS}
+        self.category_ore: dict[str, dict[str, int]] = {BUCKET_SUCCESS: {}, BUCKET_FAILED: {}}
+        # id() of a CustomerInvoice / CustomerInvoice_Error -> category -> øre;
+        # the invoices themselves are kept alive by invoice_customer_dict / failed_customer_list
+        self.invoice_ore: dict[int, dict[str, int]] = {}
+
+    @property
+    def total_amount_all(self) -> float:
+        return ore_to_dkk(self.bucket_ore[BUCKET_ALL])
+
+    @property
+    def total_amount_success(self) -> float:
+        return ore_to_dkk(self.bucket_ore[BUCKET_SUCCESS])
+
+    @property
+    def total_amount_failed(self) -> float:
+        return ore_to_dkk(self.bucket_ore[BUCKET_FAILED])
+
+    @property
+    def total_amount_failed_cf(self) -> float:
+        return ore_to_dkk(self.bucket_ore[BUCKET_FAILED_CF])
+
+    @property
+    def total_amount_no_customer_id(self) -> float:
+        return ore_to_dkk(self.bucket_ore[BUCKET_NO_CUSTOMER_ID])
+
+    @property
+    def billed_invoice_kay(self) -> dict[str, float]:
+        return {key: ore_to_dkk(ore) for key, ore in self.category_ore[BUCKET_SUCCESS].items()}
+
+    @property
+    def billed_invoice_kay_fail(self) -> dict[str, float]:
+        return {key: ore_to_dkk(ore) for key, ore in self.category_ore[BUCKET_FAILED].items()}
+
+    def add_line(self, customer_invoice, cat_key, amount):
+        """Count one produced line on its customer invoice (and failed CF customers)."""
+        ore = to_ore(amount)
+        totals = self.invoice_ore.setdefault(id(customer_invoice), {})
+        totals[cat_key] = totals.get(cat_key, 0) + ore
+        if isinstance(customer_invoice, CustomerInvoice_Error):
+            self.bucket_ore[BUCKET_FAILED_CF] += ore
+
+    def invoice_total_ore(self, customer_invoice) -> int:
+        return sum(self.invoice_ore.get(id(customer_invoice), {}).values())
+
+    def add_failed_customer(self, catKey, record):
+        self.bucket_ore[BUCKET_NO_CUSTOMER_ID] += to_ore(record.get("Amount", 0))
+
+        self.no_customer_id_rows.append(convert_row_to_dict(catKey, record))
+
+    def add_to_total_amount(self, record):
+        self.bucket_ore[BUCKET_ALL] += to_ore(record.get("Amount", 0))
+
+    def add_no_customer_id_row(self, amount_val, cat_key, record, name_key="", vat_key=""):
         try:
             if cat_key == "Impossible Cloud":
                 amount_val = float(record.get("Quantity", 0) or 0)*50
@@ -54,12 +189,13 @@ class recon_data:
         except (TypeError, ValueError):
             amount_val = 0.0
 
-        cls.total_amount_no_customer_id += amount_val  # Ingen Customer Id i række kan ikke tildele til kunde
-        old_amount = cls.billed_invoice_kay_fail.get(cat_key, 0.0)
-        cls.billed_invoice_kay_fail[cat_key] = old_amount + amount_val
+        ore = to_ore(amount_val)
+        self.bucket_ore[BUCKET_NO_CUSTOMER_ID] += ore  # Ingen Customer Id i række kan ikke tildele til kunde
+        failed = self.category_ore[BUCKET_FAILED]
+        failed[cat_key] = failed.get(cat_key, 0) + ore
 
 
-        cls.no_customer_id_rows.append(
+        self.no_customer_id_rows.append(
             {
                 "Category": cat_key,
                 "InvoicePeriodStart": record.get("Start Date", ""),
@@ -77,62 +213,35 @@ class recon_data:
             }
         )
 
-    @staticmethod
-    def reset():
-        recon_data.total_failed_cf = None
-        recon_data.total_amount_all = 0.0
-        recon_data.total_amount_success = 0.0
-        recon_data.total_amount_failed = 0.0
-        recon_data.total_amount_no_customer_id = 0.0
-        recon_data.success_rows = []
-        recon_data.no_customer_id_rows = []
-        recon_data.failedList = []
-        recon_data.invoice_customer_dict= {}
-        recon_data.failed_customer_list = {}
-        recon_data.billed_invoice_kay= {}
-        recon_data.billed_invoice_kay_fail= {}
-
-
-def report_success_or_failure(invoice, success):
-    # Sum invoice amount: ren Amount (CloudFactory-beløb)
-    inv_amount = 0.0
-    for key, category in invoice.categories.items():
-        cat_total = recon_data.billed_invoice_kay.get(key, 0.0)
-        cat_total_fail = recon_data.billed_invoice_kay_fail.get(key, 0.0)
-
-        for line in category.lines:
-            try:
-                inv_amount += round(float(line.Amount or 0),2)
-                if success:
-                    cat_total+= round(float(line.Amount or 0),2)
-                else:
-                    cat_total_fail+= round(float(line.Amount or 0),2)
-
-            except (TypeError, ValueError):
-                pass
-        if success:
-            recon_data.billed_invoice_kay[key] = cat_total
-        else:
-            recon_data.billed_invoice_kay_fail[key] = cat_total_fail
-
-    if success:
-        # No new failure added => this invoice was successfully posted
-        recon_data.total_amount_success += inv_amount
-    else:
-        # This invoice ended up in failedList
-        recon_data.failedList.append(invoice)
-        cust = invoice.customer
-        recon_data.success_rows.append(
-            {
-                "Customer ID": cust.id,
-                "Customer Name": cust.name,
-                "VAT": cust.vatID,
-                "Country": cust.countryCode,
-                "Total Amount (DKK)": inv_amount,
-            }
-        )
 
-        recon_data.total_amount_failed += inv_amount
+def report_success_or_failure(context, invoice, success):
+    with context.lock:
+        # Invoice amount: ren Amount (CloudFactory-beløb), summeret i øre da linjerne blev lavet
+        bucket = BUCKET_SUCCESS if success else BUCKET_FAILED
+        cat_totals = context.category_ore[bucket]
+        line_totals = context.invoice_ore.get(id(invoice), {})
+
+        inv_ore = 0
+        for key in invoice.categories.keys():
+            ore = line_totals.get(key, 0)
+            inv_ore += ore
+            cat_totals[key] = cat_totals.get(key, 0) + ore
+
+        context.bucket_ore[bucket] += inv_ore
+
+        if not success:
+            # This invoice ended up in failedList
+            context.failedList.append(invoice)
+            cust = invoice.customer
+            context.success_rows.append(
+                {
+                    "Customer ID": cust.id,
+                    "Customer Name": cust.name,
+                    "VAT": cust.vatID,
+                    "Country": cust.countryCode,
+                    "Total Amount (DKK)": ore_to_dkk(inv_ore),
+                }
+            )
 
 
 def compute_line_total(line) -> float:
@@ -151,27 +260,18 @@ def compute_line_total(line) -> float:
     except Exception:
         return 0.0
 
-def export_failed_customers_csv(failed_customer_list, output_path: Path) -> float:
+def export_failed_customers_csv(context, output_path: Path) -> float:
     """
     CloudFactory-rækker der IKKE kunne matches til en CloudFactory-kunde.
-    Beløb beregnes som Amount (CloudFactory-beløb).
+    Beløb er Amount (CloudFactory-beløb), læst fra context's øre-totaler.
     Returnerer totalbeløb.
     """
     rows = []
-    total_failed = 0.0
 
-    for customerid, customer_invoice in failed_customer_list.items():
+    for customerid, customer_invoice in context.failed_customer_list.items():
         reason = getattr(customer_invoice, "reason", "Unknown")
 
-        total_amount = 0.0
-        for category in customer_invoice.categories.values():
-            for line in category.lines:
-                try:
-                    total_amount += float(line.Amount or 0)
-                except Exception:
-                    pass
-
-        total_failed += total_amount
+        total_amount = ore_to_dkk(context.invoice_total_ore(customer_invoice))
 
         customer_name = (
             customer_invoice.customer.name
@@ -190,6 +290,8 @@ def export_failed_customers_csv(failed_customer_list, output_path: Path) -> floa
             "Total Amount (DKK)": total_amount,
         })
 
+    total_failed = context.total_amount_failed_cf
+
     if not rows:
         print("No failed CloudFactory customers – nothing to write to CSV.")
         return 0.0
@@ -203,29 +305,24 @@ def export_failed_customers_csv(failed_customer_list, output_path: Path) -> floa
     print(f"Failed customer CSV exported -> {output_file.resolve()}")
     return total_failed
 
-def export_missing_debtors_csv(failed_invoices, output_path: Path) -> float:
+def export_missing_debtors_csv(context, output_path: Path, name_matcher=None) -> float:
     """
-    Kunder hvor vi IKKE fandt en debitor i Uniconta.
-    Beløb beregnes som Amount.
+    Kunder hvor vi IKKE fandt en debitor i Uniconta (context.failedList).
+    Beløb er Amount, læst fra context's øre-totaler.
+    Med name_matcher (DebtorNameMatcher) får hver kunde forslag til debitorer ud fra navnet.
     Returnerer totalbeløb.
     """
     rows = []
-    total_failed = 0.0
+    total_failed = 0
 
-    for inv in failed_invoices:
+    for inv in context.failedList:
         cust = inv.customer
         if not cust:
             continue
 
-        total_amount = 0.0
-        for category in inv.categories.values():
-            for line in category.lines:
-                try:
-                    total_amount += float(line.Amount or 0)
-                except Exception:
-                    pass
-
-        total_failed += total_amount
+        inv_ore = context.invoice_total_ore(inv)
+        total_failed += inv_ore
+        total_amount = ore_to_dkk(inv_ore)
 
         rows.append({
             "Customer ID": cust.id,
@@ -235,6 +332,8 @@ def export_missing_debtors_csv(failed_invoices, output_path: Path) -> float:
             "Reason": "No matching debtor in Uniconta (find_deptor returned none)",
             "Total Amount (DKK)": total_amount,
         })
+        if name_matcher is not None:
+            rows[-1]["Suggested Uniconta debtors"] = name_matcher.suggest_text(cust.name, cust.countryCode)
 
     if not rows:
         print("No missing debtors – all CustomerInvoices found a debtor in Uniconta.")
@@ -247,7 +346,7 @@ def export_missing_debtors_csv(failed_invoices, output_path: Path) -> float:
         writer.writerows(rows)
 
     print(f"Missing debtors CSV exported -> {output_file.resolve()}")
-    return total_failed
+    return ore_to_dkk(total_failed)
 
 def export_success_invoices_csv(success_rows, output_path: Path) -> float:
     """
@@ -269,22 +368,18 @@ def export_success_invoices_csv(success_rows, output_path: Path) -> float:
     print(f"Success invoices CSV exported -> {output_file.resolve()}")
     return total_success
 
-def export_no_customer_id_csv(no_id_rows, output_path: Path) -> float:
+def export_no_customer_id_csv(context, output_path: Path) -> float:
     """
     Linjer i billing-Excel uden Customer Id (enten mangler id-kolonne
     helt eller feltet er tomt). Beløb = Amount.
     Returnerer totalbeløbet.
     """
+    no_id_rows = context.no_customer_id_rows
     if not no_id_rows:
         print("No 'no customer id' rows – nothing to write to CSV.")
         return 0.0
 
-    total = 0.0
-    for r in no_id_rows:
-        try:
-            total += float(r.get("Amount", 0.0) or 0.0)
-        except Exception:
-            pass
+    total = context.total_amount_no_customer_id
 
     output_file = Path(output_path)
     with output_file.open("w", newline="", encoding="utf-8") as f:
@@ -310,25 +405,25 @@ def print_invoices(invoice_customer_dict):
                 print("         |")
         print("")
 
-def setupStreamletPage(found_cat_key_dict):
+def setupStreamletPage(context, found_cat_key_dict, name_matcher=None):
     # ------------------------------------------------------------------
     # Export CSVs for Streamlit / reporting
     # ------------------------------------------------------------------
     # 1) Successful invoices
-    success_csv_path = OUTPUT_DIR / "success_invoices.csv"
-    total_success_csv = export_success_invoices_csv(recon_data.success_rows, success_csv_path)
+    success_csv_path = context.output_dir / "success_invoices.csv"
+    total_success_csv = export_success_invoices_csv(context.success_rows, success_csv_path)
 
     # 2) CloudFactory mapping failures (failedCustomerlist)
-    failed_cf_csv_path = OUTPUT_DIR / "failed_customers.csv"
-    total_failed_cf = export_failed_customers_csv(recon_data.failed_customer_list, failed_cf_csv_path)
+    failed_cf_csv_path = context.output_dir / "failed_customers.csv"
+    total_failed_cf = export_failed_customers_csv(context, failed_cf_csv_path)
 
     # 3) Uniconta debtor failures (failedList)
-    failed_debtors_csv_path = OUTPUT_DIR / "failed_debtors_uniconta.csv"
-    total_failed_debtors_csv = export_missing_debtors_csv(recon_data.failedList, failed_debtors_csv_path)
+    failed_debtors_csv_path = context.output_dir / "failed_debtors_uniconta.csv"
+    total_failed_debtors_csv = export_missing_debtors_csv(context, failed_debtors_csv_path, name_matcher)
 
     # 4) No customer id lines
-    no_customerid_csv_path = OUTPUT_DIR / "no_customerid_lines.csv"
-    total_no_customerid_csv = export_no_customer_id_csv(recon_data.no_customer_id_rows, no_customerid_csv_path)
+    no_customerid_csv_path = context.output_dir / "no_customerid_lines.csv"
+    total_no_customerid_csv = export_no_customer_id_csv(context, no_customerid_csv_path)
 
     # Debug: which categories did we see at all?
     print("\n=== CloudFactory billing categories discovered ===")
@@ -336,38 +431,50 @@ def setupStreamletPage(found_cat_key_dict):
     print("=================================================\n")
 
     # --- Reconciliation summary (console) ---
+    # sums of buckets are taken in øre, converted to DKK once
+    buckets = context.bucket_ore
+    header_total = ore_to_dkk(buckets[BUCKET_ALL] + buckets[BUCKET_NO_CUSTOMER_ID])
+    check_total = ore_to_dkk(buckets[BUCKET_SUCCESS] + buckets[BUCKET_FAILED] + buckets[BUCKET_FAILED_CF])
+
     print("=== RECONCILIATION SUMMARY (ex. VAT) ===")
-    print(f"Total CloudFactory per-customer amount processed         : {recon_data.total_amount_all+recon_data.total_amount_no_customer_id:,.2f} DKK")
-    print(f"  -> Mapped to existing Uniconta debtors                  : {recon_data.total_amount_success:,.2f} DKK")
-    print(f"  -> No matching debtor in Uniconta (skipped)             : {recon_data.total_amount_failed:,.2f} DKK")
+    print(f"Total CloudFactory per-customer amount processed         : {header_total:,.2f} DKK")
+    print(f"  -> Mapped to existing Uniconta debtors                  : {context.total_amount_success:,.2f} DKK")
+    print(f"  -> No matching debtor in Uniconta (skipped)             : {context.total_amount_failed:,.2f} DKK")
     print(f"  -> No matching CloudFactory customer (failed mapping)   : {total_failed_cf:,.2f} DKK")
-    print(f"  -> Lines with NO customer id in billing file            : {recon_data.total_amount_no_customer_id:,.2f} DKK")
+    print(f"  -> Lines with NO customer id in billing file            : {context.total_amount_no_customer_id:,.2f} DKK")
     print(
         "Check (success + failed_debtors + failed_cf_customers)   : "
-        f"{(recon_data.total_amount_success + recon_data.total_amount_failed + total_failed_cf):,.2f} DKK"
+        f"{check_total:,.2f} DKK"
     )
     print(
         "Invoice header total (per-customer + no-id)              : "
-        f"{(recon_data.total_amount_all + recon_data.total_amount_no_customer_id):,.2f} DKK"
+        f"{header_total:,.2f} DKK"
     )
+    stats = context.debtor_index_stats
+    if stats:
+        print(
+            f"Uniconta debtor index: {stats['source']}, {stats['debtors']} debtors, "
+            f"built in {stats['build_seconds']:.1f}s, {stats['age_seconds'] / 3600:.1f}h old"
+        )
     print("=========================================\n")
 
-    for failed in recon_data.failedList:
+    for failed in context.failedList:
         print(failed)
 
     # ------------------------------------------------------------------
     # Write reconciliation JSON for Streamlit
     # ------------------------------------------------------------------
     reconciliation = {
-        "total_cloudfactory_amount": round(recon_data.total_amount_all, 2),
-        "total_success_amount": round(recon_data.total_amount_success, 2),
-        "total_failed_debtors_amount": round(recon_data.total_amount_failed, 2),
+        "total_cloudfactory_amount": round(context.total_amount_all, 2),
+        "total_success_amount": round(context.total_amount_success, 2),
+        "total_failed_debtors_amount": round(context.total_amount_failed, 2),
         "total_failed_cloudfactory_customers_amount": round(total_failed_cf, 2),
-        "total_no_customerid_amount": round(recon_data.total_amount_no_customer_id, 2),
+        "total_no_customerid_amount": round(context.total_amount_no_customer_id, 2),
         "success_csv": str(success_csv_path),
         "failed_customers_csv": str(failed_cf_csv_path),
         "failed_debtors_csv": str(failed_debtors_csv_path),
         "no_customerid_csv": str(no_customerid_csv_path),
+        "debtor_index": context.debtor_index_stats,
         "calculation_notes_da": {
             "cloudfactory_total": (
                 "CloudFactory totalen (per kunde) er baseret på feltet 'Amount' i "
@@ -394,7 +501,7 @@ def setupStreamletPage(found_cat_key_dict):
         },
     }
 
-    recon_path = OUTPUT_DIR / "reconciliation_summary.json"
+    recon_path = context.output_dir / "reconciliation_summary.json"
     with recon_path.open("w", encoding="utf-8") as f:
         json.dump(reconciliation, f, indent=2, ensure_ascii=False)
 
@@ -2,8 +2,8 @@ import json
 import io
 import traceback
 import subprocess
+import uuid
 from pathlib import Path
-from contextlib import redirect_stdout, redirect_stderr
 
 import pandas as pd
 import streamlit as st
@@ -11,9 +11,24 @@ import streamlit as st
 APP_DIR = Path(__file__).resolve().parent
 OUTPUT_DIR = APP_DIR / "reconcilliation" / "output"
 SUMMARY_PATH = OUTPUT_DIR / "reconciliation_summary.json"
+# hver Streamlit-session får sin egen output-mappe herunder
+SESSIONS_DIR = OUTPUT_DIR / "sessions"
 
 
-def run_main_script():
+def session_output_dir() -> Path:
+    """Output-mappe for denne session, så samtidige sessioner ikke overskriver hinandens CSV/JSON."""
+    if "session_output_dir" not in st.session_state:
+        st.session_state.session_output_dir = SESSIONS_DIR / uuid.uuid4().hex
+    return st.session_state.session_output_dir
+
+
+def summary_path() -> Path:
+    """Sessionens resumé, ellers det fælles fra en kørsel af main.py i terminalen."""
+    path = session_output_dir() / SUMMARY_PATH.name
+    return path if path.exists() else SUMMARY_PATH
+
+
+def run_main_script(refresh_cache: bool = False):
     """Kør main.py med samme Python som Streamlit bruger."""
     script_path = APP_DIR / "main.py"
     if not script_path.exists():
@@ -24,12 +39,15 @@ def run_main_script():
         from dotenv import load_dotenv
         load_dotenv()
 
+        import main
+        from reconcilliation.utils import ReconciliationContext
+
+        # output goes to this run's buffers only; redirect_stdout would swap
+        # sys.stdout for every session in the process
         stdout_buf = io.StringIO()
         stderr_buf = io.StringIO()
-
-        with redirect_stdout(stdout_buf), redirect_stderr(stderr_buf):
-            import main
-            rc = main.main()
+        context = ReconciliationContext(session_output_dir(), stdout=stdout_buf, stderr=stderr_buf)
+        rc = main.main(REFRESH_CACHE=str(refresh_cache), context=context)
 
         returncode = 0 if rc in (None, 0) else int(rc)
 
@@ -52,14 +70,15 @@ def run_main_script():
 
 def load_summary():
     """Læs JSON-resumé af afstemningen."""
-    if not SUMMARY_PATH.exists():
+    path = summary_path()
+    if not path.exists():
         return None
 
     try:
-        with SUMMARY_PATH.open("r", encoding="utf-8") as f:
+        with path.open("r", encoding="utf-8") as f:
             data = json.load(f)
     except Exception as e:
-        st.error(f"Kunne ikke læse {SUMMARY_PATH.name}: {e}")
+        st.error(f"Kunne ikke læse {path.name}: {e}")
         return None
 
     return data
@@ -72,7 +91,7 @@ def load_csv(path_str: str):
 
     path = Path(path_str)
     if not path.is_absolute():
-        path = OUTPUT_DIR / path_str
+        path = summary_path().parent / path_str
 
     if not path.exists():
         return None
@@ -96,6 +115,20 @@ def format_currency(value):
         return "-"
 
 
+def show_delete_summary(summary, what, filter_text):
+    """Resultat af en sletning: antal slettet/fejlet og hastighed."""
+    if summary.failed:
+        st.warning(
+            f"⚠️ Slettede {summary.deleted} af {summary.requested} {what} for {filter_text}. "
+            f"{summary.failed} fejlede."
+        )
+        with st.expander("Fejl"):
+            st.code("\n".join(summary.errors))
+    else:
+        st.success(f"✅ Slettede {summary.deleted} {what} i Uniconta for {filter_text}.")
+    st.caption(f"{summary.seconds:.1f} sek · {summary.rows_per_second:.0f} rækker/sek")
+
+
 # ----------------------------
 # Streamlit setup
 # ----------------------------
@@ -143,9 +176,15 @@ if "erase_found_for_reference" not in st.session_state:
 col_run, col_admin = st.columns([3, 1])
 
 with col_run:
+    refresh_cache = st.checkbox(
+        "Hent data fra CloudFactory forfra (ignorér cache)",
+        value=False,
+        help="Som standard genbruges billing-Excel for samme fakturaperiode og kundelisten fra disken.",
+        key="chk_refresh_cache",
+    )
     if st.button("Kør afstemning nu", key="btn_run_reconciliation"):
         with st.spinner("Afstemning kører..."):
-            result = run_main_script()
+            result = run_main_script(refresh_cache=refresh_cache)
 
         if result is None:
             st.stop()
@@ -313,12 +352,16 @@ with col_admin:
                     try:
                         load_dotenv()
                         adapter = UnicontaClient()
-                        delete_debtor_orders(adapter, orders)
-
-                        st.success(
-                            f"✅ Slettede {len(orders)} ordre(r) i Uniconta for YourRef = '{st.session_state.erase_your_ref}'."
+                        progress_bar = st.progress(0.0, text="Sletter ordrer…")
+                        summary = delete_debtor_orders(
+                            adapter, orders,
+                            progress=lambda done, total: progress_bar.progress(
+                                done / total if total else 1.0, text=f"Sletter ordrer… {done}/{total}"
+                            ),
                         )
 
+                        show_delete_summary(summary, "ordre(r)", f"YourRef = '{st.session_state.erase_your_ref}'")
+
                         st.session_state.erase_orders = []
                         st.session_state.erase_found_for_ref = None
                         st.session_state.erase_last_action = "deleted"
@@ -377,10 +420,16 @@ with col_admin:
                     try:
                         load_dotenv()
                         adapter = UnicontaClient()
-                        delete_debtor_order_lines(adapter, lines)
+                        progress_bar = st.progress(0.0, text="Sletter linjer…")
+                        summary = delete_debtor_order_lines(
+                            adapter, lines,
+                            progress=lambda done, total: progress_bar.progress(
+                                done / total if total else 1.0, text=f"Sletter linjer… {done}/{total}"
+                            ),
+                        )
 
-                        st.success(
-                            f"✅ Slettede {len(lines)} linje(r) i Uniconta for ReferenceNumber = '{st.session_state.erase_reference_number}'."
+                        show_delete_summary(
+                            summary, "linje(r)", f"ReferenceNumber = '{st.session_state.erase_reference_number}'"
                         )
 
                         st.session_state.erase_lines = []
@@ -499,6 +548,16 @@ else:
 
     st.caption("Alle summer er baseret på CloudFactory-feltet 'Amount' i billing-filerne.")
 
+    debtor_index = summary.get("debtor_index") or {}
+    if debtor_index:
+        sources = {"snapshot": "fra disk", "delta": "opdateret (ændringer)", "full": "hentet forfra"}
+        st.caption(
+            f"Uniconta-debitorindeks: {debtor_index.get('debtors', 0)} debitorer, "
+            f"{sources.get(debtor_index.get('source'), debtor_index.get('source'))}, "
+            f"bygget på {debtor_index.get('build_seconds', 0):.1f} sek, "
+            f"{debtor_index.get('age_seconds', 0) / 3600:.1f} timer gammelt"
+        )
+
 st.divider()
 
 st.subheader("Detaljeret afstemning")